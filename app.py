@@ -8,6 +8,7 @@ import dash_bootstrap_components as dbc
 from components.navbar import navbar, create_navbar
 from dash import Dash, html, dcc
 from pathlib import Path
+from ursa.tiles import register_tiles
 from ursa.utils.image import b64_image
 from dash.dependencies import Input, Output, State
 
@@ -28,6 +29,9 @@ app = Dash(
     external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.BOOTSTRAP],
 )
 
+# Tiles of the raster overlays of the maps
+register_tiles(app.server)
+
 content = dcc.Loading(
     children=[
         html.Div(
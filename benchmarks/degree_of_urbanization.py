@@ -0,0 +1,231 @@
+""" Benchmark of the degree of urbanization steps against their previous
+implementations, which looped over every cluster label with full image
+masks.
+
+Runs on a synthetic population density grid with thousands of clusters,
+so no data is downloaded, and checks that both implementations give the
+same arrays.
+
+    python -m benchmarks.degree_of_urbanization --size 3000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import ursa.degree_of_urbanization as dou
+
+from scipy.ndimage import center_of_mass, convolve, gaussian_filter, label
+
+
+def make_density(size, seed=0):
+    """Returns a synthetic population density grid of size x size pixels,
+    in people per km^2, with a dense core and many small settlements."""
+
+    rng = np.random.default_rng(seed)
+
+    # Small settlements, of a few pixels each
+    density = gaussian_filter(rng.random((size, size)), 3)
+    density = (density - density.mean()) / density.std()
+    density = np.clip(density - 2, 0, None) * 600
+
+    # Dense core
+    yy, xx = np.mgrid[-1 : 1 : size * 1j, -1 : 1 : size * 1j]
+    density += 5000 * np.exp(-(xx**2 + yy**2) * 20)
+
+    return density.astype("float32")
+
+
+def get_clusters(pop_array, u_cluster_density=300):
+    """Urban array and cluster labels, as in find_urban_clusters."""
+
+    u_cluster_array = np.zeros_like(pop_array, dtype="uint8")
+    u_cluster_array[pop_array >= u_cluster_density] = 1
+
+    kernel8 = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    clusters, nclusters = label(u_cluster_array, structure=kernel8)
+
+    return u_cluster_array, clusters, nclusters
+
+
+def loop_filter(pop_array, u_cluster_array, clusters, nclusters, min_pop=5000):
+    """Population filtering as computed before, with a mask per cluster."""
+
+    labels = []
+    for lbl in range(1, nclusters + 1):
+        mask = clusters == lbl
+        total_pop = pop_array[mask].sum()
+        if total_pop < min_pop:
+            u_cluster_array[mask] = 0
+            clusters[mask] = 0
+        else:
+            labels.append(lbl)
+
+    return labels
+
+
+def new_filter(pop_array, u_cluster_array, clusters, nclusters, min_pop=5000):
+    keep = dou.filter_clusters(clusters, nclusters, pop_array, min_pop)
+    removed = ~keep[clusters]
+    u_cluster_array[removed] = 0
+    clusters[removed] = 0
+
+    return np.flatnonzero(keep)
+
+
+def loop_smooth(u_array, clusters, labels):
+    """Majority rule smoothing as computed before, convolving the whole
+    image for each cluster and iteration."""
+
+    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
+    for lbl in labels:
+        current_center = (clusters == lbl).astype("int8")
+        while True:
+            n_nbrs = convolve(current_center, kernel, mode="constant", output="int8")
+            mask = n_nbrs >= 5
+            if mask.sum() == 0:
+                break
+            current_center[mask] = 1
+            u_array[mask] += 1
+
+
+def loop_fill(u_array, min_hole_size=100):
+    """Hole filling as computed before, with a mask per hole."""
+
+    inverted = 1 - u_array
+    holes, nholes = label(inverted)
+    for h in range(1, nholes + 1):
+        mask = holes == h
+        if mask.sum() <= min_hole_size:
+            u_array[mask] = 1
+
+
+def loop_stats(class_array, pop_array, builtup_array, name, cell_area=0.01):
+    """Cluster statistics of get_stats_dict as computed before, with a
+    mask per cluster."""
+
+    class_array, ncenters = label(class_array, structure=np.ones((3, 3)))
+
+    stat_list = []
+    for lbl in range(1, ncenters + 1):
+        mask = class_array == lbl
+        stat_dict = {"Grupo": f"{name} {lbl}"}
+        stat_dict["Area"] = mask.sum() * cell_area
+        stat_dict["Area_fraction"] = stat_dict["Area"] / (class_array.size * cell_area)
+        stat_dict["Pob"] = pop_array[mask].sum() * cell_area
+        stat_dict["Pop_density"] = stat_dict["Pob"] / stat_dict["Area"]
+        stat_dict["Pop_fraction"] = stat_dict["Pob"] / pop_array.sum()
+        stat_dict["Builtup_area"] = builtup_array[mask].sum() * cell_area
+        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / (
+            builtup_array.sum() * cell_area
+        )
+        stat_dict["centroid"] = center_of_mass(mask)
+        stat_list.append(stat_dict)
+
+    return stat_list
+
+
+def compare(title, old, new, make_args):
+    """Times old and new on copies of the same arguments, and checks they
+    leave them equal."""
+
+    print(title)
+    old_args = make_args()
+    start = time.perf_counter()
+    old(*old_args)
+    t_old = time.perf_counter() - start
+
+    new_args = make_args()
+    start = time.perf_counter()
+    new(*new_args)
+    t_new = time.perf_counter() - start
+
+    for old_arg, new_arg in zip(old_args, new_args):
+        assert np.array_equal(old_arg, new_arg), "Arrays differ."
+
+    print(f"    before:  {t_old:.3f} s")
+    print(f"    after:   {t_new:.3f} s")
+    print(f"    speedup: {t_old / t_new:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size", type=int, default=3000, help="Side of the grid in pixels."
+    )
+    parser.add_argument(
+        "--small-size",
+        type=int,
+        default=1000,
+        help="Side of the grid in pixels for smoothing and statistics, which "
+        "are much slower before.",
+    )
+    args = parser.parse_args()
+
+    density = make_density(args.size)
+    u_array, clusters, nclusters = get_clusters(density)
+    print(f"Grid of {args.size} x {args.size} pixels, {nclusters} clusters.")
+
+    compare(
+        "Population filtering of urban clusters",
+        lambda *a: loop_filter(density, *a),
+        lambda *a: new_filter(density, *a),
+        lambda: (u_array.copy(), clusters.copy(), nclusters),
+    )
+
+    # Urban everywhere but in the settlements, which become holes
+    holes_array = (density < 1).astype("uint8")
+    _, nholes = label(1 - holes_array)
+    print(f"Grid of {args.size} x {args.size} pixels, {nholes} holes.")
+
+    compare(
+        "Hole filling",
+        loop_fill,
+        lambda *a: dou.fill_holes(*a, 100),
+        lambda: (holes_array.copy(),),
+    )
+
+    density = make_density(args.small_size)
+    u_array, clusters, nclusters = get_clusters(density)
+    labels = new_filter(density, u_array, clusters, nclusters)
+    print(
+        f"Grid of {args.small_size} x {args.small_size} pixels, "
+        f"{len(labels)} clusters above 5000 people."
+    )
+
+    compare(
+        "Majority rule smoothing of urban clusters",
+        lambda *a: loop_smooth(*a, labels),
+        lambda *a: dou.smooth_clusters(*a, labels),
+        lambda: (u_array.copy(), clusters.copy()),
+    )
+
+    # Statistics of every cluster of 300 people per km^2 or more
+    builtup = np.clip(density / 3000, 0, 1).astype("float32")
+    u_array, _, nclusters = get_clusters(density)
+    print(f"Statistics of {nclusters} clusters")
+
+    start = time.perf_counter()
+    expected = pd.DataFrame(loop_stats(u_array, density, builtup, "Cluster"))
+    t_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = pd.DataFrame(
+        dou.get_stats_dict(u_array, density, builtup, "Cluster", 0, connectivity=8)
+    )
+    t_new = time.perf_counter() - start
+
+    # Sums are accumulated in float64 instead of the arrays' float32
+    columns = expected.columns.drop(["Grupo", "centroid"])
+    assert (result.Grupo == expected.Grupo).all(), "Statistics differ."
+    assert np.allclose(result[columns], expected[columns], rtol=1e-5)
+    assert np.allclose(result.centroid.tolist(), expected.centroid.tolist())
+
+    print(f"    before:  {t_old:.3f} s")
+    print(f"    after:   {t_new:.3f} s")
+    print(f"    speedup: {t_old / t_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+""" Benchmark of the urban growth table, zonal sums from a label raster
+against the previous implementation, which clipped the built and pop
+rasters with the cluster polygons four times per epoch.
+
+Runs on synthetic SMOD, BUILT_S and POP stacks, so no data is downloaded,
+and checks that both implementations give the same sums.
+
+    python -m benchmarks.growth_stats --size 60
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import rioxarray  # noqa: F401
+import ursa.ghsl as ghsl
+import xarray as xr
+
+from pathlib import Path
+from rasterio.transform import from_origin
+from scipy.ndimage import gaussian_filter
+from shapely.geometry import Point
+
+YEARS = list(range(1975, 2021, 5))
+
+
+def make_stack(data, resolution, x0, y0):
+    height, width = data.shape[1:]
+    stack = xr.DataArray(
+        data,
+        dims=["band", "y", "x"],
+        coords={
+            "band": YEARS,
+            "y": y0 - resolution * (np.arange(height) + 0.5),
+            "x": x0 + resolution * (np.arange(width) + 0.5),
+        },
+    )
+    stack = stack.rio.write_crs("ESRI:54009")
+    stack = stack.rio.write_transform(from_origin(x0, y0, resolution, resolution))
+
+    return stack
+
+
+def make_datasets(size, seed=0):
+    """Returns synthetic SMOD, BUILT_S and POP stacks covering size x size
+    kilometers, with clusters growing around the center."""
+
+    rng = np.random.default_rng(seed)
+    x0, y0 = -7_000_000.0, -2_000_000.0
+
+    # Smooth density field at 100 m, growing with time
+    base = gaussian_filter(rng.random((size * 10, size * 10)), 8)
+    base = (base - base.min()) / (base.max() - base.min())
+    yy, xx = np.mgrid[-1 : 1 : size * 10j, -1 : 1 : size * 10j]
+    base = base * np.exp(-(xx**2 + yy**2) * 2)
+    growth = np.linspace(0.6, 1.2, len(YEARS))[:, None, None]
+    density = (base[None] * growth).astype("float32")
+
+    built = make_stack(density * 10_000, 100, x0, y0)
+    pop = make_stack(density * 200, 100, x0, y0)
+
+    # SMOD classes at 1 km from the mean density
+    coarse = density.reshape(len(YEARS), size, 10, size, 10).mean(axis=(2, 4))
+    smod = np.full(coarse.shape, 11, dtype="uint8")
+    smod[coarse > 0.25] = 21
+    smod[coarse > 0.45] = 30
+    smod = make_stack(smod, 1000, x0, y0)
+
+    centroid = Point(x0 + size * 500, y0 - size * 500)
+
+    return smod, built, pop, centroid
+
+
+def clip_sums(smod, built, pop, centroid):
+    """Cluster sums as computed before, clipping each epoch's rasters."""
+
+    smod_gdf = ghsl.smod_polygons(smod, centroid)
+    clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
+    main_cluster = clusters_gdf[clusters_gdf.is_main]
+
+    sums = []
+    for year in smod.coords["band"].values:
+        if main_cluster[main_cluster.year == year].empty:
+            sums.append([0, 0, 0, 0])
+            continue
+
+        cluster = main_cluster[main_cluster.year == year].geometry.iloc[0]
+        cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
+
+        row = []
+        for geoms in [[cluster], cluster_all]:
+            for raster in [built, pop]:
+                row.append(
+                    np.nansum(
+                        raster.sel(band=year)
+                        .rio.set_nodata(0)
+                        .rio.clip(geoms, crs=raster.rio.crs)
+                        .values
+                    )
+                )
+        sums.append(row)
+
+    return np.array(sums)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size", type=int, default=60, help="Side of the region in kilometers."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs.")
+    args = parser.parse_args()
+
+    smod, built, pop, centroid = make_datasets(args.size)
+    print(f"Region of {args.size} x {args.size} km, {len(YEARS)} epochs.")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        times_clip = []
+        times_labels = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            expected = clip_sums(smod, built, pop, centroid)
+            times_clip.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            df = ghsl.get_urb_growth_df(smod, built, pop, centroid, Path(tmp_dir))
+            times_labels.append(time.perf_counter() - start)
+
+    result = df[
+        [
+            "built_cluster_main",
+            "pop_cluster_main",
+            "built_cluster_all",
+            "pop_cluster_all",
+        ]
+    ].to_numpy(copy=True)
+    result[:, 0] *= 1e6
+    result[:, 2] *= 1e6
+    assert np.allclose(result, expected, rtol=1e-5), "Sums differ."
+
+    print(f"    rio.clip per epoch: {min(times_clip):.3f} s")
+    print(f"    label raster:       {min(times_labels):.3f} s")
+    print(f"    speedup:            {min(times_clip) / min(times_labels):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
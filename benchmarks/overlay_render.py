@@ -0,0 +1,145 @@
+""" Benchmark of the rendering of the map overlays, palette PNGs colored
+through lookup tables at native resolution against the previous
+implementation, which colored float RGBA arrays with matplotlib and
+upscaled them 10 times.
+
+Runs on synthetic BUILT_S and POP stacks, so no data is downloaded, and
+reports the render time and the size of the image sent in the figure.
+
+    python -m benchmarks.overlay_render --size 60
+"""
+
+import argparse
+import base64
+import io
+import time
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import numpy as np
+import ursa.ghsl as ghsl
+import ursa.utils.raster as ru
+import ursa.utils.render as ur
+
+from benchmarks.growth_stats import make_datasets
+from PIL import Image, ImageOps
+
+HIGH_RES_SIZE = 3000
+
+
+def to_payload(img):
+    """Encodes an image as plotly does for mapbox image layers."""
+
+    with io.BytesIO() as f:
+        img.save(f, format="PNG")
+        return "data:image/png;base64," + base64.b64encode(f.getvalue()).decode()
+
+
+def upscale(img):
+    factor = max(1, min(10, HIGH_RES_SIZE // max(img.size)))
+
+    return img.resize(
+        [hw * factor for hw in img.size], resample=Image.Resampling.NEAREST
+    )
+
+
+def rgba_built_agg(built, thresh=0.2):
+    """First epoch image as rendered before."""
+
+    pixel_area = abs(np.prod(built.rio.resolution()))
+    epochs = ghsl.load_or_get_first_epoch(built, thresh * pixel_area, "BUILT_S")
+    epochs = epochs.rio.reproject("EPSG:4623")
+
+    colors_rgba = [plt.cm.get_cmap("cividis", 10)(i) for i in range(10)]
+    colors = (np.array(colors_rgba) * 255).astype("uint8")
+    built_img = np.zeros((*epochs.shape, 4), dtype="uint8")
+    for year, color in zip(range(1, 11), colors):
+        built_img[epochs == year] = color
+
+    return to_payload(upscale(ImageOps.flip(Image.fromarray(built_img))))
+
+
+def rgba_built_year(built, year=2020):
+    """Built fraction image as rendered before."""
+
+    pixel_area = abs(np.prod(built.rio.resolution()))
+    built = ghsl.to_density(built.sel(band=year), pixel_area)
+    built = built.rio.reproject(dst_crs=4326)
+
+    cmap = plt.get_cmap("cividis").copy()
+    colorized = cmap(built)
+    colorized[built.values == 0] = (0, 0, 0, 0)
+    colorized = np.uint8(colorized * 255)
+
+    return to_payload(upscale(ImageOps.flip(Image.fromarray(colorized))))
+
+
+def rgba_pop_year(pop, year=2020):
+    """Population image as rendered before."""
+
+    pixel_area = abs(np.prod(pop.rio.resolution())) / 1e6
+    pop = ghsl.to_density(pop.sel(band=year), pixel_area)
+    pop = pop.rio.reproject(dst_crs=4326)
+    pop = pop * ru.get_area_grid(pop, "km")
+
+    n_classes = 7
+    pop_min = min(np.unique(pop)[1], 5.0)
+    bounds = np.array(
+        [-1, pop_min / 2.0, 5.5, 20.5, 100.5, 300.5, 500.5, 1000.5, 10000]
+    )
+    norm = mpl.colors.BoundaryNorm(boundaries=bounds, ncolors=n_classes + 1)
+    pop_norm = norm(pop).data / n_classes
+
+    cmap = plt.get_cmap("cividis").copy()
+    colorized = cmap(pop_norm)
+    colorized[pop_norm == 0] = (0, 0, 0, 0)
+    colorized = np.uint8(colorized * 255)
+
+    return to_payload(upscale(ImageOps.flip(Image.fromarray(colorized))))
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size", type=int, default=60, help="Side of the region in kilometers."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs.")
+    args = parser.parse_args()
+
+    _, built, pop, _ = make_datasets(args.size)
+    print(f"Region of {args.size} x {args.size} km, {built.shape[1:]} pixels.")
+
+    layers = [
+        ("built_agg", rgba_built_agg, lambda: ghsl.render_built_agg(built), built),
+        ("built_year", rgba_built_year, lambda: ghsl.render_built_year(built), built),
+        ("pop_year", rgba_pop_year, lambda: ghsl.render_pop_year(pop), pop),
+    ]
+    for name, render_rgba, render_lut, raster in layers:
+        t_rgba, payload_rgba = best_time(lambda: render_rgba(raster), args.repeat)
+        t_lut, (payload_lut, _) = best_time(render_lut, args.repeat)
+        t_cached, _ = best_time(
+            lambda: ur.load_or_render(("benchmark", name), render_lut), args.repeat
+        )
+
+        print(name)
+        print(f"    RGBA, upscaled: {t_rgba:.3f} s, {len(payload_rgba) / 1e6:.2f} MB")
+        print(f"    palette, LUT:   {t_lut:.3f} s, {len(payload_lut) / 1e6:.2f} MB")
+        print(f"    cached:         {t_cached * 1e6:.0f} us")
+        print(
+            f"    speedup:        {t_rgba / t_lut:.1f}x, "
+            f"payload {len(payload_rgba) / len(payload_lut):.1f}x smaller"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -51,7 +51,7 @@ def calculate_coverage(worldcover, sleuth_predictions, start_year):
     # Crear un diccionario de kernels
     kernels = {}
     for key, value in world_cover_type.items():
-        kernels[key] = np.where(worldcover == value, 1, 0)
+        kernels[key] = worldcover == value
 
     # Inicializar un DataFrame vacío
     result_df = pd.DataFrame()
@@ -269,7 +269,7 @@ def load_sleuth_predictions(path_cache, id_hash, mode):
     else:
         download_sleuth_predictions(path_cache, id_hash, mode)
 
-    return np.load(path_cache / local_filename)
+    return np.load(path_cache / local_filename, mmap_mode="r")
 
 
 def plot_sleuth_predictions(grid, start_year, num_years, language='es'):
@@ -349,13 +349,14 @@ def summary(id_hash, urban_rasters, years, language = "es"):
     }
     
     path_cache = Path(f"./data/cache/{id_hash}")
-    worldcover = np.load(path_cache / "worldcover.npy")
+    worldcover = np.load(path_cache / "worldcover.npy", mmap_mode="r")
     start_year = 2020
     num_years = 50
 
     id_hash = str(id_hash)
     historical_years = np.array(years)
-    historical_grids = np.array(urban_rasters)
+    # No copy when given the memory mapped rasters
+    historical_grids = np.asarray(urban_rasters)
     
     modes_translated = translations[language]['modes']
     
@@ -387,10 +387,10 @@ def download_file(id_hash, n_clicks):
     path_cache = Path(f"./data/cache/{str(id_hash)}")
 
     rasters: list[str] = [
-        path_cache / "GHS_BUILT_S_100.tif",
-        #path_cache / 'GHS_LAND_100.tif',
-        path_cache / "GHS_POP_100.tif",
-        path_cache / "GHS_SMOD_1000.tif",
+        ghsl.get_cache_path(path_cache, "BUILT_S", 100),
+        #ghsl.get_cache_path(path_cache, "LAND", 100),
+        ghsl.get_cache_path(path_cache, "POP", 100),
+        ghsl.get_cache_path(path_cache, "SMOD", 1000),
         #path_cache / 'dou.tif',
         #path_cache / 'protected.tif',
         #path_cache / 'slope.tif'
@@ -451,7 +451,7 @@ def generate_lines(id_hash, bbox_latlon, uc_latlon, btn_lang_es, btn_lang_en, bt
 
     smod, built, pop = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
 
-    growth_df = ghsl.get_urb_growth_df(
+    growth_df = ghsl.load_or_get_urb_growth_df(
         smod=smod,
         built=built,
         pop=pop,
@@ -565,12 +565,41 @@ def generate_lines(id_hash, bbox_latlon, uc_latlon, btn_lang_es, btn_lang_en, bt
             plots.append(dash.no_update)
             error_triggered = True
 
-    map1 = ghsl.plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, language = language)
-    map2 = ghsl.plot_smod_clusters(smod, bbox_latlon, language=language)
+    # Image overlays are drawn from coarser rasters sized to the figure,
+    # tiles are rendered from the cache and only need the stacks' bounds
+    if ghsl.use_tiles(path_cache):
+        map_built, map_pop = built, pop
+    else:
+        map_built, map_pop = ghsl.load_preview_datasets(bbox_mollweide, path_cache)
+
+    map1 = ghsl.plot_built_agg_img(
+        smod,
+        map_built,
+        bbox_mollweide,
+        centroid_mollweide,
+        language=language,
+        path_cache=path_cache,
+    )
+    map2 = ghsl.plot_smod_clusters(
+        smod, bbox_latlon, language=language, path_cache=path_cache
+    )
     map3 = ghsl.plot_built_year_img(
-        smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, language = language
+        smod,
+        map_built,
+        bbox_latlon,
+        bbox_mollweide,
+        centroid_mollweide,
+        language=language,
+        path_cache=path_cache,
+    )
+    map4 = ghsl.plot_pop_year_img(
+        smod,
+        map_pop,
+        bbox_mollweide,
+        centroid_mollweide,
+        language=language,
+        path_cache=path_cache,
     )
-    map4 = ghsl.plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, language = language)
 
     plots.append(map1)
     plots.append(map2)
@@ -10,6 +10,7 @@ from dash import callback, html, Input, Output, State
 from pathlib import Path
 from shapely.geometry import shape
 from ursa.utils.geometry import geometry_to_json, hash_geometry
+from ursa.utils.subregion import link_parent
 
 
 dash.register_page(__name__, path="/")
@@ -305,6 +306,7 @@ def set_custom_bbox(n_clicks, geojson, bbox_orig):
 
     bbox_json = features[0]["geometry"]
     bbox = shape(bbox_json)
+    parent_hash = hash_geometry(bbox_orig)
     bbox_orig = shape(bbox_orig)
 
     if not bbox_orig.contains(bbox):
@@ -320,6 +322,9 @@ def set_custom_bbox(n_clicks, geojson, bbox_orig):
     path_cache = Path(f"./data/cache/{str(id_hash)}")
     path_cache.mkdir(exist_ok=True, parents=True)
 
+    # Inputs are derived from the city's cache instead of downloaded again
+    link_parent(path_cache, Path(f"./data/cache/{str(parent_hash)}"))
+
     if len(features) == 1:
         return bbox_json, id_hash, dash.no_update, dash.no_update, dash.no_update
     else:
@@ -1585,7 +1585,7 @@ def download_orig_raster(n_clicks, id_hash):
 
     triggered_field = dash.callback_context.triggered_id["field"]
     fpath = PATH_CACHE / id_hash / f"{triggered_field}.npy"
-    data = np.load(fpath)
+    data = np.load(fpath, mmap_mode="r")
     data = data.astype(rio.int32)
 
     fpath_attrs = PATH_CACHE / id_hash / "attributes.json"
@@ -1693,7 +1693,7 @@ def update_arrays(uploaded, id_hash):
 def restore_raster(n_clicks, id_hash):
     id_hash = str(id_hash)
     triggered_field = dash.callback_context.triggered_id["field"]
-    arr = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy")
+    arr = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy", mmap_mode="r")
     
     with open(PATH_CACHE / id_hash / "attributes.json", "r") as f:
         attrs = json.load(f)
@@ -1870,7 +1870,7 @@ def update_ranges(c_min, c_max, c_num):
 def update_custom_raster_results(current, id_hash):
     id_hash = str(id_hash)
     triggered_field = dash.callback_context.triggered_id["field"]
-    original = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy")
+    original = np.load(PATH_CACHE / id_hash / f"{triggered_field}.npy", mmap_mode="r")
 
     return ("No", "No") if np.array_equal(current, original, equal_nan=True) else ("Sí", "Sí")
 
@@ -2336,7 +2336,9 @@ def download_data(id_hash, bbox_latlon, btn_lang_es, btn_lang_en, btn_lang_pt):
     out_rasters = []
     urban_rasters = None
     for field in RASTER_FIELDS:
-        raster = np.load(path_cache / f"{field}.npy")
+        # Memory mapped, pages are shared between sessions through the
+        # OS page cache and only read when serialized or summarized
+        raster = np.load(path_cache / f"{field}.npy", mmap_mode="r")
         out_rasters.append(raster)
         if field == "urban":
             urban_rasters = raster
@@ -51,7 +51,7 @@ def calculate_coverage(worldcover, sleuth_predictions, start_year):
     # Crear un diccionario de kernels
     kernels = {}
     for key, value in world_cover_type.items():
-        kernels[key] = np.where(worldcover == value, 1, 0)
+        kernels[key] = worldcover == value
 
     # Inicializar un DataFrame vacío
     result_df = pd.DataFrame()
@@ -227,7 +227,7 @@ def load_sleuth_predictions(path_cache, id_hash, mode):
     else:
         download_sleuth_predictions(path_cache, id_hash, mode)
 
-    return np.load(path_cache / local_filename)
+    return np.load(path_cache / local_filename, mmap_mode="r")
 
 
 def plot_sleuth_predictions(grid, start_year, num_years):
@@ -259,7 +259,7 @@ def plot_sleuth_predictions(grid, start_year, num_years):
 def summary(id_hash, urban_rasters, years):
     path_cache = Path(f"./data/cache/{id_hash}")
 
-    worldcover = np.load(path_cache / "worldcover.npy")
+    worldcover = np.load(path_cache / "worldcover.npy", mmap_mode="r")
 
     start_year = 2020
     num_years = 50
@@ -268,7 +268,8 @@ def summary(id_hash, urban_rasters, years):
     id_hash = str(id_hash)
 
     historical_years = np.array(years)
-    historical_grids = np.array(urban_rasters)
+    # No copy when given the memory mapped rasters
+    historical_grids = np.asarray(urban_rasters)
 
     x = list(historical_years)
     y = [grid.sum() / grid.size for grid in historical_grids]
@@ -1,11 +1,26 @@
+import multiprocessing
+
 import numpy as np
 import pandas as pd
 import rioxarray as rxr
 import xarray as xr
 
-from scipy.ndimage import label, convolve, center_of_mass
-from ursa.ghsl import load_or_download
-
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy.ndimage import (
+    center_of_mass,
+    convolve,
+    find_objects,
+    label,
+    sum_labels,
+)
+from ursa.ghsl import load_or_download_many, to_density
+from ursa.utils.cache_lock import atomic_path, single_flight
+
+# Number of processes computing the DoU of the epochs of a city, as each
+# epoch is independent. If 1, epochs are computed in the calling process,
+# as the app does. Batch jobs, like ursa.utils.warm_cache, raise it.
+MAX_WORKERS = 1
 
 lvl_1_classes = {
     # 'Urban Center': 3,
@@ -14,6 +29,157 @@ lvl_1_classes = {
 }
 
 
+def filter_clusters(clusters, nclusters, pop_array, min_pop):
+    """Finds the clusters with a total population of at least min_pop,
+    summing the population of every cluster in a single pass.
+
+    Parameters
+    ----------
+    clusters : np.array
+        Array of cluster labels, as returned by scipy.ndimage.label.
+    nclusters : int
+        Number of clusters.
+    pop_array : np.array
+        Population array.
+    min_pop : float
+        Minimum total population of a cluster.
+
+    Returns
+    -------
+    keep : np.array
+        Boolean lookup table, indexed by label, True for the clusters to
+        keep. The background, label 0, is never kept.
+
+    """
+
+    total_pop = sum_labels(pop_array, clusters, index=np.arange(1, nclusters + 1))
+
+    # Clusters with NaN population are kept, as a comparison with NaN is
+    # never True
+    keep = np.zeros(nclusters + 1, dtype=bool)
+    keep[1:] = ~(total_pop < min_pop)
+
+    return keep
+
+
+def pack_slices(slices):
+    """Places rectangles of the sizes of slices side by side in rows of a
+    single array, leaving a gap of one pixel between them.
+
+    Parameters
+    ----------
+    slices : list of tuple
+        List of 2D slices, as returned by scipy.ndimage.find_objects.
+
+    Returns
+    -------
+    shape : tuple
+        Shape of the array holding all rectangles.
+    offsets : list of tuple
+        Row and column of the upper left corner of each rectangle.
+
+    """
+
+    heights = [sl[0].stop - sl[0].start for sl in slices]
+    widths = [sl[1].stop - sl[1].start for sl in slices]
+    area = sum((h + 1) * (w + 1) for h, w in zip(heights, widths))
+    width = max(max(widths) + 1, int(np.ceil(np.sqrt(area))))
+
+    # Tallest rectangles first, filling a row before starting the next
+    offsets = [None] * len(slices)
+    row, col, row_height = 1, 1, 0
+    for i in np.argsort(heights, kind="stable")[::-1]:
+        if col + widths[i] + 1 > width:
+            row, col, row_height = row + row_height + 1, 1, 0
+        offsets[i] = (row, col)
+        col += widths[i] + 1
+        row_height = max(row_height, heights[i])
+
+    return (row + row_height + 1, width), offsets
+
+
+def smooth_clusters(u_array, clusters, labels):
+    """Fills gaps and smooths the borders of clusters with the majority
+    rule: non urban cells with at least 5 of their 8 neighbors in a
+    cluster join it, iteratively until no more cells are added.
+
+    Cells added to a cluster are counted in u_array, so cells added to
+    more than one cluster, or added to a cluster while belonging to
+    another, end up with counts above 1.
+
+    As a cell outside the bounding box of a cluster has at most 3
+    neighbors in it, clusters only grow inside their bounding boxes. The
+    bounding boxes of all clusters are packed in a single array, so all
+    clusters grow together, a convolution per iteration, instead of
+    convolving the whole image for each cluster and iteration.
+
+    Parameters
+    ----------
+    u_array : np.array
+        Urban array, updated in place.
+    clusters : np.array
+        Array of cluster labels.
+    labels : list of int
+        Labels of the clusters to smooth.
+
+    """
+
+    if len(labels) == 0:
+        return
+
+    slices = find_objects(clusters)
+    slices = [slices[lbl - 1] for lbl in labels]
+    shape, offsets = pack_slices(slices)
+
+    current = np.zeros(shape, dtype="int8")
+    inside = np.zeros(shape, dtype=bool)
+    for lbl, sl, (row, col) in zip(labels, slices, offsets):
+        h, w = sl[0].stop - sl[0].start, sl[1].stop - sl[1].start
+        current[row : row + h, col : col + w] = clusters[sl] == lbl
+        inside[row : row + h, col : col + w] = True
+    initial = current.astype(bool)
+
+    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
+    while True:
+        # Find number of neighbors of each cell
+        # Non urban pixels have neighbor values 0-8, while urban
+        # pixels have -8-0
+        n_nbrs = convolve(current, kernel, mode="constant", output="int8")
+        # New cells are non urban pixels with >=5 neighbors
+        mask = (n_nbrs >= 5) & inside
+        if not mask.any():
+            break
+        current[mask] = 1
+
+    added = current.astype(bool) & ~initial
+    for sl, (row, col) in zip(slices, offsets):
+        h, w = sl[0].stop - sl[0].start, sl[1].stop - sl[1].start
+        u_array[sl] += added[row : row + h, col : col + w]
+
+
+def fill_holes(u_array, min_hole_size):
+    """Fills the holes of an urban array with at most min_hole_size cells,
+    in place. The size of every hole is computed in a single pass.
+
+    Parameters
+    ----------
+    u_array : np.array
+        Urban array of 0s and 1s.
+    min_hole_size : int
+        Maximum number of cells of the holes to fill.
+
+    """
+
+    # Invert image
+    inverted = 1 - u_array
+    # Find all holes smaller than min size
+    holes, nholes = label(inverted)
+    sizes = np.bincount(holes.ravel(), minlength=nholes + 1)
+    small = sizes <= min_hole_size
+    small[0] = False
+    u_array[small[holes]] = 1
+
+
 def find_urban_centers(
     pop_array,
     builtup_array,
@@ -34,49 +200,23 @@ def find_urban_centers(
 
     # Find their total population and remove them from
     # urban center array if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_center_pop:
-            u_center_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    keep = filter_clusters(clusters, nclusters, pop_array, u_center_pop)
+    removed = ~keep[clusters]
+    u_center_array[removed] = 0
+    clusters[removed] = 0
+    labels = np.flatnonzero(keep)
 
     # Fill gaps and smooth borders, majority rule
     # Apply per urban center, find all candidates
     # for allocation
-    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-    for lbl in labels:
-        # This needs to be done iteratively until no more additions are performed
-        current_center = (clusters == lbl).astype(int)
-        while True:
-            # Find number of neighbors of each cell
-            # Non urban pixels have neighbor values 0-8, while urban
-            # pixels have -8-0
-            n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-            # New cells are non urban pixels with >=5 neighbors
-            mask = n_nbrs >= 5
-            if mask.sum() == 0:
-                break
-            # Update both current center and urban_center_array
-            current_center[mask] = 1
-            u_center_array[mask] += 1
+    smooth_clusters(u_center_array, clusters, labels)
     # Cells added to more than one urban center have counts > 1.
     # Remove them
     u_center_array[u_center_array > 1] = 0
 
     if fill:
         # Fill holes smaller than min hole size, defaults to 15km
-        # Invert image
-        inverted = 1 - u_center_array
-        # Find all holes smaller than min size
-        holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_center_array[mask] = 1
+        fill_holes(u_center_array, min_hole_size)
 
     return u_center_array
 
@@ -100,51 +240,24 @@ def find_urban_clusters(
 
     # Find their total population and remove them from
     # if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_cluster_pop:
-            u_cluster_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    keep = filter_clusters(clusters, nclusters, pop_array, u_cluster_pop)
+    removed = ~keep[clusters]
+    u_cluster_array[removed] = 0
+    clusters[removed] = 0
+    labels = np.flatnonzero(keep)
 
     if smooth:
         # Fill gaps and smooth borders, majority rule
         # Apply per urban center, find all candidates
         # for allocation
-        kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-        for lbl in labels:
-            # This needs to be done iteratively until no more
-            # additions are performed
-            current_center = (clusters == lbl).astype(int)
-            while True:
-                # Find number of neighbors of each cell
-                # Non urban pixels have neighbor values 0-8, while urban
-                # pixels have -8-0
-                n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-                # New cells are non urban pixels with >=5 neighbors
-                mask = n_nbrs >= 5
-                if mask.sum() == 0:
-                    break
-                # Update both current center and urban_center_array
-                current_center[mask] = 1
-                u_cluster_array[mask] += 1
+        smooth_clusters(u_cluster_array, clusters, labels)
         # Cells added to more than one urban center have counts > 1.
         # Remove them
         u_cluster_array[u_cluster_array > 1] = 0
 
     if fill:
         # Fill holes smaller min_hole_size, defaults to 1km
-        # Invert image
-        inverted = 1 - u_cluster_array
-        # Find all holes smaller than min size
-        holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_cluster_array[mask] = 1
+        fill_holes(u_cluster_array, min_hole_size)
 
     return u_cluster_array
 
@@ -188,20 +301,33 @@ def get_stats_dict(
             class_array, ncenters = label(class_array)
         classes = {f"{classes} {lbl}": lbl for lbl in range(1, ncenters + 1)}
 
-    for c, l in classes.items():
-        mask = class_array == l
+    if len(classes) == 0:
+        return stat_list
+
+    # Statistics of all classes in a single pass over each array
+    index = np.array(list(classes.values()))
+    counts = np.bincount(class_array.ravel(), minlength=index.max() + 1)[index]
+    area = counts * cell_area
+    pob = sum_labels(pop_array, class_array, index) * cell_area
+    builtup_area = sum_labels(builtup_array, class_array, index) * cell_area
+    centroids = center_of_mass(
+        np.ones(class_array.shape, dtype="uint8"), class_array, index
+    )
+    total_area = class_array.size * cell_area
+    total_pop = pop_array.sum()
+    total_builtup_area = builtup_array.sum() * cell_area
+
+    for i, c in enumerate(classes):
         stat_dict = {"Grupo": c}
         stat_dict["year"] = year
-        stat_dict["Area"] = mask.sum() * cell_area
-        stat_dict["Area_fraction"] = stat_dict["Area"] / (class_array.size * cell_area)
-        stat_dict["Pob"] = pop_array[mask].sum() * cell_area
+        stat_dict["Area"] = area[i]
+        stat_dict["Area_fraction"] = stat_dict["Area"] / total_area
+        stat_dict["Pob"] = pob[i]
         stat_dict["Pop_density"] = stat_dict["Pob"] / stat_dict["Area"]
-        stat_dict["Pop_fraction"] = stat_dict["Pob"] / pop_array.sum()
-        stat_dict["Builtup_area"] = builtup_array[mask].sum() * cell_area
-        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / (
-            builtup_array.sum() * cell_area
-        )
-        stat_dict["centroid"] = center_of_mass(mask)
+        stat_dict["Pop_fraction"] = stat_dict["Pob"] / total_pop
+        stat_dict["Builtup_area"] = builtup_area[i]
+        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / total_builtup_area
+        stat_dict["centroid"] = centroids[i]
         stat_list.append(stat_dict)
     return stat_list
 
@@ -217,7 +343,7 @@ def get_stats_df(dou_array, pop_array, builtup_array, year):
         #     year
         # )
         + get_stats_dict(
-            (dou_array > 1).astype(int),
+            (dou_array > 1).astype("uint8"),
             pop_array,
             builtup_array,
             "Cluster",
@@ -263,30 +389,69 @@ def stats_for_largest_cluster(df_stats):
 def load_input_data_ghs(bbox_mollweide, path_cache, resolution=100):
     print("Loading GHS datasets for Degree of Urbanization ...")
 
+    keys = ["BUILT_S", "POP", "LAND"]
+    res_list = load_or_download_many(
+        bbox_mollweide, [(key, resolution) for key in keys], data_path=path_cache
+    )
+
     rasters = {}
-    for key in ["BUILT_S", "POP", "LAND"]:
-        res = load_or_download(
-            bbox_mollweide, key, data_path=path_cache, resolution=resolution
-        )
+    for key, res in zip(keys, res_list):
         res = res.rio.set_nodata(0)
         rasters[key] = res
 
     # Get population density grid in km^2
     cell_area = rasters["POP"].rio.resolution()[0] ** 2
-    pop_density = rasters["POP"] / cell_area * 1e6
+    pop_density = to_density(rasters["POP"], cell_area, 1e6)
 
     # Get built-up grid
     # Convert to builtup fraction
-    built_fraction = rasters["BUILT_S"] / cell_area
+    built_fraction = to_density(rasters["BUILT_S"], cell_area)
 
     # Get land fraction grid
-    land_fraction = rasters["LAND"] / cell_area
+    land_fraction = to_density(rasters["LAND"], cell_area)
 
     print("Done.")
 
     return pop_density, built_fraction, land_fraction
 
 
+def dou_for_year(
+    density,
+    builtup,
+    year,
+    u_center_density=1500,
+    u_center_pop=50000,
+    builtup_trshld=0.5,
+    u_cluster_density=300,
+    u_cluster_pop=5000,
+):
+    """Computes the DoU of a single epoch and its statistics.
+
+    Returns
+    -------
+    dou_array : np.array
+        DoU level 1 classes.
+    df_stats : DataFrame
+        Statistics of the classes and clusters, see get_stats_df.
+
+    """
+
+    print(f"Calculating DoU for year {year}...")
+    dou_xr = dou_lvl1(
+        density,
+        builtup,
+        u_center_density,
+        u_center_pop,
+        builtup_trshld,
+        u_cluster_density,
+        u_cluster_pop,
+    )
+
+    df_stats = get_stats_df(dou_xr.values, density.values, builtup.values, year)
+
+    return dou_xr.values, df_stats
+
+
 def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
     (pop_density, built_fraction, land_fraction) = load_input_data_ghs(
         bbox_mollweide, path_cache, resolution
@@ -311,51 +476,57 @@ def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
     u_cluster_density = 300
     u_cluster_pop = 5000
 
-    df_list = []
-    xr_list = []
-    for year in year_list:
-        print(f"Calculating DoU for year {year}...")
-        density = pop_density.sel(band=year)
-        builtup = built_fraction.sel(band=year)
-
-        print("    Building array...")
-        dou_xr = dou_lvl1(
-            density,
-            builtup,
-            u_center_density,
-            u_center_pop,
-            builtup_trshld,
-            u_cluster_density,
-            u_cluster_pop,
-        )
+    densities = [pop_density.sel(band=year) for year in year_list]
+    builtups = [built_fraction.sel(band=year) for year in year_list]
+    func = partial(
+        dou_for_year,
+        u_center_density=u_center_density,
+        u_center_pop=u_center_pop,
+        builtup_trshld=builtup_trshld,
+        u_cluster_density=u_cluster_density,
+        u_cluster_pop=u_cluster_pop,
+    )
 
-        print("    Getting stats...")
-        df_stats = get_stats_df(dou_xr.values, density.values, builtup.values, year)
-
-        # dou_xr.rio.to_raster(path_cache / f'dou_{year}.tif')
-        # harmonize from previous year
-        if year > year_list[0]:
-            prev = xr_list[-1].values
-            dou_xr.values = np.logical_or(prev, dou_xr.values).astype("uint8")
-        xr_list.append(dou_xr)
-        df_list.append(df_stats)
-        print("Done.")
+    # Epochs are independent, only their harmonization is sequential
+    n_workers = max(1, min(MAX_WORKERS or 1, len(year_list)))
+    if n_workers > 1:
+        # Spawned, as forked workers may inherit locks held by other threads
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(executor.map(func, densities, builtups, year_list))
+    else:
+        results = list(map(func, densities, builtups, year_list))
+    print("Done.")
+
+    # harmonize from previous years, urban cells stay urban
+    dou_arrays = np.stack([dou_array for dou_array, _ in results]).astype(bool)
+    dou_arrays = np.logical_or.accumulate(dou_arrays, axis=0).astype("uint8")
+
+    xr_list = [
+        density.copy(data=dou_array)
+        for density, dou_array in zip(densities, dou_arrays)
+    ]
+    df_list = [df_stats for _, df_stats in results]
     dou_full = xr.concat(xr_list, pd.Index(year_list, name="year"))
-    dou_full.rio.to_raster(path_cache / "dou.tif")
+    with atomic_path(path_cache / "dou.tif") as tmp_path:
+        dou_full.rio.to_raster(tmp_path)
     df_stats = pd.concat(df_list)
     df_stats["centroid"] = df_stats.centroid.apply(lambda x: np.array(x))
     # df_largest = stats_for_largest_cluster(df_stats)
 
-    df_stats.to_csv(path_cache / "dou_stats.csv")
+    with atomic_path(path_cache / "dou_stats.csv") as tmp_path:
+        df_stats.to_csv(tmp_path)
     # df_largest.to_csv(path_cache / 'dou_largest.csv')
 
 
 def load_or_process_dou(bbox_mollweide, path_cache, force=False):
     fpath = path_cache / "dou.tif"
-    if fpath.exists() and not force:
-        pass
-    else:
-        dou_for_ghs(bbox_mollweide, path_cache)
+    with single_flight(fpath):
+        if fpath.exists() and not force:
+            pass
+        else:
+            dou_for_ghs(bbox_mollweide, path_cache)
     raster = rxr.open_rasterio(fpath, cache=False)
     raster.coords["band"] = list(range(1975, 2021, 5))
 
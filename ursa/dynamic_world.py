@@ -8,6 +8,7 @@ import ursa.utils.date as du
 import ursa.utils.raster as ru
 
 from shapely.geometry import Polygon
+from ursa.utils.cache_lock import atomic_path, single_flight
 
 class_dict = {
     "0": "Agua",
@@ -300,7 +301,8 @@ def get_cover_df(bbox_latlon, path_cache):
     df = pd.DataFrame(dict_list).set_index("year").rename(columns=class_dict)
     df = df * 100 / 1e6
     df = df[columns]
-    df.to_csv(path_cache / "land_cover.csv")
+    with atomic_path(path_cache / "land_cover.csv") as tmp_path:
+        df.to_csv(tmp_path)
 
     print("Done.")
 
@@ -309,10 +311,11 @@ def get_cover_df(bbox_latlon, path_cache):
 
 def load_or_get_lc_df(bbox_latlon, path_cache, force=False):
     fpath = path_cache / "land_cover.csv"
-    if fpath.exists() and not force:
-        df = pd.read_csv(fpath, index_col="year")
-    else:
-        df = get_cover_df(bbox_latlon, path_cache)
+    with single_flight(fpath):
+        if fpath.exists() and not force:
+            df = pd.read_csv(fpath, index_col="year")
+        else:
+            df = get_cover_df(bbox_latlon, path_cache)
     return df
 
 
@@ -1,4 +1,5 @@
-import os
+import hashlib
+import threading
 
 import geemap.plotlymap as geemap
 import geopandas as gpd
@@ -7,35 +8,241 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import rasterio as rio
 import rioxarray as rxr
-import tempfile
+import shapely
 import ursa.utils.raster as ru
+import ursa.utils.render as ur
 
-from PIL import Image, ImageOps
-from shapely.geometry import shape
+from collections import OrderedDict
+from pathlib import Path
+from scipy.ndimage import label
+from urllib.parse import urlencode
+from ursa.utils.cache_lock import atomic_path, single_flight
+from ursa.utils.subregion import find_parent_file
 
 HEIGHT = 600
-HIGH_RES = True
+
+# Upscale overlay images embedded in the figures, so they stay sharp when
+# zooming in. Tiles are always sharp, and palette images are small enough
+# to be sent at native resolution.
+HIGH_RES = False
+
+# Maximum size in pixels, along the longest side, of the rasters used for
+# map previews. Larger bounding boxes are read at a coarser resolution.
+PREVIEW_SIZE = 2 * HEIGHT
+
+# Maximum size in pixels of overlay images upscaled when HIGH_RES is set
+HIGH_RES_SIZE = 3000
+
+# Serve the raster overlays of the maps as XYZ tiles rendered on demand by
+# the app's server (see ursa.tiles), instead of embedding them in the
+# figures as images. Only figures built with a city cache use tiles.
+TILES = True
+
+# URL of the overlay tiles of a layer, see ursa.tiles.register_tiles
+TILE_URL = "/tiles/{cache}/{layer}/{{z}}/{{x}}/{{y}}.png"
+
+# Use compact dtypes along the GHSL -> DoU -> SLEUTH pipeline: float32
+# densities computed in place, and uint8 masks and SLEUTH inputs. If False,
+# densities are float64 and SLEUTH inputs int32, as numpy defaults give.
+COMPACT_DTYPES = True
+
+# File format of the cached GHS stacks, either "tif" for multiband
+# GeoTIFFs or "nc" for chunked and compressed NetCDF files. NetCDF stacks
+# are read lazily, a band at a time.
+CACHE_FORMAT = "tif"
+
+# Directory of the tile cache of the global COGs, shared by all cities.
+# Set to None to read windows directly from S3.
+BLOCK_CACHE_DIR = Path("./data/cache/blocks")
+
+# Source of the global COGs, see ru.make_source. Defaults to the public
+# S3 bucket, and can be switched to a local mirror (see
+# ursa.utils.mirror_ghsl) or an S3 compatible endpoint through the
+# URSA_RASTER_SOURCE, URSA_RASTER_ROOT, URSA_S3_ENDPOINT and URSA_S3_BUCKET
+# environment variables.
+RASTER_SOURCE = ru.source_from_env()
+
+# Every GHS product used by the app, as (data set, resolution) pairs
+GHS_PRODUCTS = [("SMOD", 1000), ("BUILT_S", 100), ("POP", 100), ("LAND", 100)]
+
+# Number of derived artifacts (SMOD polygons, urban growth tables) kept in
+# memory by each process, on top of their Parquet files in the city cache
+MEMO_SIZE = 32
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
 
 url_pop = "https://doi.org/10.2905/D6D86A90-4351-4508-99C1-CB074B022C4A"
 url_built = "https://doi.org/10.2905/D07D81B4-7680-4D28-B896-583745C27085"
 url_smod = "https://doi.org/10.2905/4606D58A-DC08-463C-86A9-D49EF461C47F"
 
 
+def get_year_list(ds):
+    """Returns the list of years available for a GHS data set."""
+
+    if ds == "LAND":
+        return [2018]
+    return list(range(1975, 2021, 5))
+
+
+def get_s3_paths(ds, resolution=1000, s3_path="GHSL/"):
+    """Returns the relative S3 path of the global COG of each available
+    year for a GHS data set."""
+
+    assert ds in ["SMOD", "BUILT_S", "POP", "LAND"], "Data set not available."
+
+    s3_path = f"{s3_path}/GHS_{ds}/"
+
+    if ds == "LAND":
+        fname = f"GHS_{ds}_E{{}}_GLOBE_R2022A_54009_{resolution}_V1_0.tif"
+    else:
+        fname = f"GHS_{ds}_E{{}}_GLOBE_R2023A_54009_{resolution}_V1_0.tif"
+
+    return [s3_path + fname.format(year) for year in get_year_list(ds)]
+
+
+def get_cache_path(data_path, ds, resolution, cache_format=None):
+    """Returns the path of the cached stack of a GHS data set."""
+
+    if cache_format is None:
+        cache_format = CACHE_FORMAT
+
+    return data_path / f"GHS_{ds}_{resolution}.{cache_format}"
+
+
+def get_source(bucket=ru.DEFAULT_BUCKET):
+    """Returns the configured source of the global COGs, falling back to
+    the public S3 bucket."""
+
+    if RASTER_SOURCE is not None:
+        return RASTER_SOURCE
+    return ru.make_source("s3", bucket)
+
+
+def to_density(raster, cell_area, scale=1):
+    """Divides a raster of totals per pixel by the pixel area, and
+    multiplies it by scale.
+
+    With COMPACT_DTYPES the result is float32, computed in place on a
+    single copy of the data, otherwise it is float64.
+    """
+
+    if not COMPACT_DTYPES:
+        return raster / cell_area * scale
+
+    data = raster.values.astype("float32")
+    data *= np.float32(scale / cell_area)
+
+    return raster.copy(data=data)
+
+
+def stack_to_raster(array_list, profile, year_list):
+    """Builds a multiband raster, a band per year, from a list of
+    windowed arrays sharing the same profile.
+
+    The raster is assembled in memory, no temporary files are written.
+    """
+
+    ghs_full = np.concatenate(array_list)
+
+    return ru.np_to_xr(ghs_full, profile, band=year_list)
+
+
+def download_s3_many(
+    bbox,
+    datasets,
+    data_path=None,
+    s3_path="GHSL/",
+    bucket=ru.DEFAULT_BUCKET,
+    source=None,
+):
+    """Downloads GHSL windowed rasters for several data sets at once.
+
+    The window reads for every (data set, year) pair are issued
+    concurrently, so the download time is bounded by the slowest read.
+    Returns a multiband raster per data set, a band per year.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    datasets : list of tuple
+        List of (ds, resolution) pairs to download. ds can be one of
+        SMOD, BUILT_S, POP, or LAND, and resolution either 100 or 1000.
+    data_path : Path
+        Path to directory to store rasters.
+        If none, don't write to disk.
+    s3_dir : str
+        Relative path to COGs on S3.
+    bucket : str
+        Name of the S3 bucket with the COGs.
+    source : dict
+        Source of the COGs, as returned by ru.make_source. Defaults to
+        RASTER_SOURCE if set, otherwise to the S3 bucket.
+
+    Returns
+    -------
+    rasters : dict
+        Dictionary mapping each (ds, resolution) pair to an in memory
+        rioxarray.DataArray.
+
+    """
+
+    paths = {
+        (ds, resolution): get_s3_paths(ds, resolution, s3_path)
+        for ds, resolution in datasets
+    }
+
+    names = ", ".join(f"{ds}_{resolution}" for ds, resolution in paths)
+    print(f"Downloading {names} rasters ...")
+
+    if source is None:
+        source = get_source(bucket)
+
+    all_paths = [path for ds_paths in paths.values() for path in ds_paths]
+    results = ru.np_from_bbox_many(
+        all_paths,
+        bbox,
+        source,
+        nodata_to_zero=True,
+        block_cache_dir=BLOCK_CACHE_DIR,
+    )
+
+    rasters = {}
+    for ds, resolution in paths:
+        n_years = len(paths[(ds, resolution)])
+        ds_results, results = results[:n_years], results[n_years:]
+
+        array_list = [subset for subset, _ in ds_results]
+        profile = ds_results[-1][1]
+        raster = stack_to_raster(array_list, profile, get_year_list(ds))
+
+        if data_path is not None:
+            ru.write_stack(raster, get_cache_path(data_path, ds, resolution))
+
+        print(f"Done: GHS_{ds}_{resolution}")
+
+        rasters[(ds, resolution)] = raster
+
+    return rasters
+
+
 def download_s3(
     bbox,
     ds,
     data_path=None,
     resolution=1000,
     s3_path="GHSL/",
-    bucket="tec-expansion-urbana-p",
+    bucket=ru.DEFAULT_BUCKET,
+    source=None,
 ):
     """Downloads a GHSL windowed rasters for each available year.
 
     Takes a bounding box (bbox) and downloads the corresponding rasters from a
-    the global COG stored on Amazon S3. Returns a single multiband raster,
-    a band per year.
+    the global COG stored on Amazon S3, or on the configured source.
+    Returns a single multiband raster, a band per year.
 
     Parameters
     ----------
@@ -51,6 +258,10 @@ def download_s3(
     s3_dir : str
         Relative path to COGs on S3.
     bucket : str
+        Name of the S3 bucket with the COGs.
+    source : dict
+        Source of the COGs, as returned by ru.make_source. Defaults to
+        RASTER_SOURCE if set, otherwise to the S3 bucket.
 
     Returns
     -------
@@ -59,43 +270,109 @@ def download_s3(
 
     """
 
-    assert ds in ["SMOD", "BUILT_S", "POP", "LAND"], "Data set not available."
+    rasters = download_s3_many(
+        bbox, [(ds, resolution)], data_path, s3_path, bucket, source
+    )
 
-    print(f"Downloading {ds} rasters ...")
+    return rasters[(ds, resolution)]
 
-    s3_path = f"{s3_path}/GHS_{ds}/"
 
-    if ds == "LAND":
-        year_list = [2018]
-        fname = f"GHS_{ds}_E{{}}_GLOBE_R2022A_54009_{resolution}_V1_0.tif"
-    else:
-        fname = f"GHS_{ds}_E{{}}_GLOBE_R2023A_54009_{resolution}_V1_0.tif"
-        year_list = list(range(1975, 2021, 5))
+def derive_from_parent(bbox, datasets, data_path):
+    """Windows the GHS stacks of a custom sub-region from the cache of its
+    parent city, see ursa.utils.subregion, and writes them to data_path.
 
-    array_list = []
-    for year in year_list:
-        subset, profile = ru.np_from_bbox_s3(
-            s3_path + fname.format(year), bbox, bucket, nodata_to_zero=True
-        )
-        array_list.append(subset)
-    ghs_full = np.concatenate(array_list)
+    Returns
+    -------
+    rasters : dict
+        Dictionary mapping each derived (ds, resolution) pair to an in
+        memory rioxarray.DataArray. Stacks the parent doesn't have are
+        left out.
 
-    # Create rioxarray
-    profile["count"] = ghs_full.shape[0]
-    tmp_name = os.path.join(tempfile.gettempdir(), os.urandom(24).hex())
-    with rio.open(tmp_name, "w", **profile) as dst:
-        dst.write(ghs_full)
-    raster = rxr.open_rasterio(tmp_name)
+    """
 
-    # Rename band dimension to reflect years
-    raster.coords["band"] = year_list
+    rasters = {}
+    for ds, resolution in datasets:
+        fpath = get_cache_path(data_path, ds, resolution)
+        parent_fpath = find_parent_file(data_path, fpath.name)
+        if parent_fpath is None:
+            continue
 
-    if data_path is not None:
-        raster.rio.to_raster(data_path / f"GHS_{ds}_{resolution}.tif")
+        raster = ru.window_stack(ru.open_stack(parent_fpath), bbox)
+        if raster is None:
+            continue
+        raster = raster.load()
+        ru.write_stack(raster, fpath)
 
-    print(f"Done: GHS_{ds}_{resolution}.tif")
+        print(f"Derived GHS_{ds}_{resolution} from {parent_fpath.parent.name}")
 
-    return raster
+        raster.coords["band"] = get_year_list(ds)
+        rasters[(ds, resolution)] = raster
+
+    return rasters
+
+
+def load_or_download_many(
+    bbox,
+    datasets,
+    data_path=None,
+    s3_path="GHSL/",
+    bucket=ru.DEFAULT_BUCKET,
+    source=None,
+):
+    """Searches for several GHS datasets to load, the ones not available
+    are downloaded concurrently from the source of the global COGs.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    datasets : list of tuple
+        List of (ds, resolution) pairs to load. ds can be one of
+        SMOD, BUILT_S, POP, or LAND, and resolution either 100 or 1000.
+    data_path : Path
+        Path to directory to store rasters.
+        If none, don't write to disk.
+    s3_dir : str
+        Relative path to COGs on S3.
+    bucket : str
+        Name of the S3 bucket with the COGs.
+    source : dict
+        Source of the COGs, as returned by ru.make_source. Defaults to
+        RASTER_SOURCE if set, otherwise to the S3 bucket.
+
+    Returns
+    -------
+    rasters : list of rioxarray.DataArray
+        In memory rasters, in the same order as datasets.
+
+    """
+
+    if data_path is None:
+        rasters = download_s3_many(bbox, datasets, None, s3_path, bucket, source)
+        return [rasters[(ds, resolution)] for ds, resolution in datasets]
+
+    fpaths = {
+        (ds, resolution): get_cache_path(data_path, ds, resolution)
+        for ds, resolution in datasets
+    }
+
+    # Concurrent requests for the same city wait for the first download
+    with single_flight(*fpaths.values()):
+        missing = [key for key, fpath in fpaths.items() if not fpath.exists()]
+        rasters = derive_from_parent(bbox, missing, data_path)
+        missing = [key for key in missing if key not in rasters]
+        if len(missing) > 0:
+            rasters.update(
+                download_s3_many(bbox, missing, data_path, s3_path, bucket, source)
+            )
+
+    for (ds, resolution), fpath in fpaths.items():
+        if (ds, resolution) not in rasters:
+            raster = ru.open_stack(fpath)
+            raster.coords["band"] = get_year_list(ds)
+            rasters[(ds, resolution)] = raster
+
+    return [rasters[(ds, resolution)] for ds, resolution in datasets]
 
 
 def load_or_download(
@@ -104,10 +381,11 @@ def load_or_download(
     data_path=None,
     resolution=1000,
     s3_path="GHSL/",
-    bucket="tec-expansion-urbana-p",
+    bucket=ru.DEFAULT_BUCKET,
+    source=None,
 ):
     """Searches for a GHS dataset to load, if not available,
-    downloads it from S3 and loads it.
+    downloads it from the source of the global COGs and loads it.
 
     Parameters
     ----------
@@ -123,6 +401,10 @@ def load_or_download(
     s3_dir : str
         Relative path to COGs on S3.
     bucket : str
+        Name of the S3 bucket with the COGs.
+    source : dict
+        Source of the COGs, as returned by ru.make_source. Defaults to
+        RASTER_SOURCE if set, otherwise to the S3 bucket.
 
     Returns
     -------
@@ -130,19 +412,316 @@ def load_or_download(
         In memory raster.
 
     """
-    fpath = data_path / f"GHS_{ds}_{resolution}.tif"
-    if fpath.exists():
-        raster = rxr.open_rasterio(fpath)
-        if ds != "LAND":
-            raster.coords["band"] = list(range(1975, 2021, 5))
-        else:
-            raster.coords["band"] = [2018]
-    else:
-        raster = download_s3(bbox, ds, data_path, resolution, s3_path, bucket)
+
+    (raster,) = load_or_download_many(
+        bbox, [(ds, resolution)], data_path, s3_path, bucket, source
+    )
+
+    return raster
+
+
+def load_or_download_preview(
+    bbox, ds, data_path=None, resolution=100, max_size=PREVIEW_SIZE, source=None
+):
+    """Loads a GHS data set for map previews, at a resolution that fits
+    in max_size pixels.
+
+    If the full resolution stack is already cached, it is aggregated in
+    memory. Otherwise, a decimated window is read from the COGs'
+    overviews, which is much smaller than the full resolution window for
+    large bounding boxes. Pixel values are totals per (larger) pixel, so
+    plot functions computing densities from the pixel size work
+    unchanged. The decimation factor is stored in the "decimation"
+    attribute. Previews are not meant for statistics.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    ds : str
+        Data set to load, can be one of BUILT_S or POP.
+    data_path : Path
+        Path to directory with cached rasters.
+    resolution : int
+        Resolution of the data set, either 100 or 1000.
+    max_size : int
+        Maximum size in pixels of the preview's longest side.
+    source : dict
+        Source of the COGs, as returned by ru.make_source.
+
+    Returns
+    -------
+    raster : rioxarray.DataArray
+        In memory raster.
+
+    """
+
+    factor = ru.get_decimation(bbox, resolution, max_size)
+    if factor == 1:
+        return load_or_download(bbox, ds, data_path, resolution, source=source)
+
+    fpath = None if data_path is None else get_cache_path(data_path, ds, resolution)
+    if fpath is not None and (
+        fpath.exists() or find_parent_file(data_path, fpath.name) is not None
+    ):
+        raster = load_or_download(bbox, ds, data_path, resolution)
+        raster = raster.rio.set_nodata(0)
+        return ru.coarsen_sum(raster, factor)
+
+    if source is None:
+        source = get_source()
+
+    print(f"Downloading GHS_{ds}_{resolution} preview, decimation {factor} ...")
+    results = ru.np_from_bbox_many(
+        get_s3_paths(ds, resolution),
+        bbox,
+        source,
+        nodata_to_zero=True,
+        decimation=factor,
+    )
+    array_list = [subset for subset, _ in results]
+    raster = stack_to_raster(array_list, results[-1][1], get_year_list(ds))
+    raster.attrs["decimation"] = factor
 
     return raster
 
 
+def load_preview_datasets(bbox_mollweide, path_cache, max_size=PREVIEW_SIZE):
+    """Loads BUILT_S and POP for map previews, see load_or_download_preview."""
+
+    built = load_or_download_preview(
+        bbox_mollweide, "BUILT_S", path_cache, 100, max_size
+    )
+    pop = load_or_download_preview(bbox_mollweide, "POP", path_cache, 100, max_size)
+
+    return built, pop
+
+
+def upscale_indices(indices):
+    """Upscales the color indices of an overlay image by repeating pixels,
+    up to 10 times and HIGH_RES_SIZE pixels, so it stays sharp on the map."""
+
+    if not HIGH_RES:
+        return indices
+
+    factor = max(1, min(10, HIGH_RES_SIZE // max(indices.shape)))
+
+    return indices.repeat(factor, axis=0).repeat(factor, axis=1)
+
+
+def use_tiles(path_cache):
+    """Returns True if the overlays of a city's maps are served as tiles."""
+
+    return TILES and path_cache is not None
+
+
+def get_tile_url(path_cache, layer, **params):
+    """Returns the XYZ template URL of the tiles of an overlay layer of a
+    city cache, with params passed as query arguments."""
+
+    url = TILE_URL.format(cache=Path(path_cache).name, layer=layer)
+    if len(params) > 0:
+        url += "?" + urlencode(params)
+
+    return url
+
+
+def overlay_layer(source, coordinates=None):
+    """Returns the mapbox layer of a raster overlay, either an image
+    covering coordinates or a tile URL template."""
+
+    if coordinates is None:
+        layer = {"sourcetype": "raster", "source": [source]}
+    else:
+        layer = {"sourcetype": "image", "source": source, "coordinates": coordinates}
+    layer.update(opacity=0.7, below="traces")
+
+    return layer
+
+
+def get_grid_key(raster):
+    """Returns a tuple identifying the grid of a raster."""
+
+    return tuple(raster.shape) + tuple(raster.rio.transform())[:6]
+
+
+def encode_overlay(indices, lut):
+    """Encodes the color indices of an overlay image, north up, as a PNG
+    data URI."""
+
+    indices = upscale_indices(np.flipud(indices))
+
+    return ur.to_data_uri(ur.to_png(indices, lut))
+
+
+def render_built_agg(built, thresh=0.2, path_cache=None):
+    """Renders the image of the first epoch built is above thresh.
+
+    Returns
+    -------
+    img : str
+        PNG data URI of the image.
+    bounds : tuple
+        Lat-lon bounds of the image.
+
+    """
+
+    pixel_area = abs(np.prod(built.rio.resolution()))
+
+    # Earliest year of observed urbanization, coded 1 to 10, where the built
+    # fraction is above thresh. Nearest neighbour reprojection of the codes
+    # gives the same result as thresholding reprojected densities.
+    built_bin_agg = load_or_get_first_epoch(
+        built, thresh * pixel_area, "BUILT_S", path_cache
+    )
+    built_bin_agg = built_bin_agg.rio.reproject("EPSG:4623")
+
+    indices = ur.epochs_indices(built_bin_agg.values)
+
+    return encode_overlay(indices, ur.EPOCHS_LUT), built_bin_agg.rio.bounds()
+
+
+def render_built_year(built, year=2020):
+    """Renders the image of the built fraction in year, see
+    render_built_agg."""
+
+    pixel_area = abs(np.prod(built.rio.resolution()))
+
+    # Select specific year and transform into density
+    # Only densitities can be safely reprojected
+    built = to_density(built.sel(band=year), pixel_area)
+    built.rio.set_nodata(0)
+
+    # Reprojecto to lat lon
+    built = built.rio.reproject(dst_crs=4326)
+
+    indices = ur.fraction_indices(built.values)
+
+    return encode_overlay(indices, ur.FRACTION_LUT), built.rio.bounds()
+
+
+def render_pop_year(pop, year=2020):
+    """Renders the image of the population classes in year, see
+    render_built_agg."""
+
+    pixel_area = abs(np.prod(pop.rio.resolution())) / 1e6
+
+    # Previews have pixels decimation times larger than the data set's
+    decimation = pop.attrs.get("decimation", 1)
+
+    # Select specific year and transform into density
+    # Only densitities can be safely reprojected
+    pop = to_density(pop.sel(band=year), pixel_area)
+    pop.rio.set_nodata(0)
+
+    # Reprojecto to lat lon
+    pop = pop.rio.reproject(dst_crs=4326)
+
+    # Get back counts, per pixel of the data set's native resolution
+    pop = pop * ru.get_area_grid(pop, "km") / decimation**2
+
+    indices = ur.pop_indices(pop.values, ur.get_pop_min(pop.values))
+
+    return encode_overlay(indices, ur.POP_LUT), pop.rio.bounds()
+
+
+def image_coordinates(bounds):
+    """Returns the corners of an overlay image from its lat-lon bounds."""
+
+    lonmin, latmin, lonmax, latmax = bounds
+
+    return [
+        [lonmin, latmin],
+        [lonmax, latmin],
+        [lonmax, latmax],
+        [lonmin, latmax],
+    ]
+
+
+def outline_coordinates(geoms):
+    """Returns the longitudes and latitudes of the exteriors of polygons,
+    as lists with None between polygons, so a single trace draws them
+    all."""
+
+    rings = shapely.get_exterior_ring(np.asarray(geoms))
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    breaks = np.flatnonzero(np.diff(index)) + 1
+
+    lons = np.insert(coords[:, 0].astype(object), breaks, None)
+    lats = np.insert(coords[:, 1].astype(object), breaks, None)
+
+    return lons.tolist(), lats.tolist()
+
+
+def lines_trace(lons, lats, name, color):
+    """Returns a Scattermapbox trace of lines, with a legend entry."""
+
+    return go.Scattermapbox(
+        lat=lats,
+        lon=lons,
+        mode="lines",
+        line_color=color,
+        name=name,
+        legendgroup=name,
+        hoverinfo="skip",
+    )
+
+
+def outline_trace(polygon, name, color="blue"):
+    """Returns the trace of the outline of a polygon in Mollweide."""
+
+    geoms = gpd.GeoSeries([polygon], crs="ESRI:54009").to_crs(4326)
+    lons, lats = outline_coordinates(geoms.values)
+
+    return lines_trace(lons, lats, name, color)
+
+
+def get_cluster_outlines(smod, centroid_mollweide, path_cache=None):
+    """Returns the outlines of the 2020 urban clusters, as a dictionary
+    with the main cluster's and the other clusters' longitudes and
+    latitudes, see outline_coordinates. Outlines are computed once per city
+    and kept in memory, as all the maps of the city draw them."""
+
+    key = ("cluster_outlines", str(path_cache))
+    key += (get_artifact_key(smod, centroid_mollweide),)
+    outlines = _memo_get(key)
+    if outlines is not None:
+        return outlines
+
+    smod_p = load_or_get_smod_polygons(smod, centroid_mollweide, path_cache)
+    clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
+    clusters_2020 = clusters_2020.to_crs(4326)
+
+    outlines = {}
+    for name, is_main in [("main", True), ("other", False)]:
+        geoms = clusters_2020.geometry[clusters_2020.is_main == is_main]
+        outlines[name] = outline_coordinates(geoms.values)
+
+    _memo_put(key, outlines)
+
+    return outlines
+
+
+def cluster_outline_traces(
+    smod, centroid_mollweide, main_name, other_name, path_cache=None
+):
+    """Returns the traces of the outlines of the 2020 urban clusters, one
+    for the main cluster and one for the others, in maroon and orange."""
+
+    outlines = get_cluster_outlines(smod, centroid_mollweide, path_cache)
+
+    traces = []
+    for key, name, color in [
+        ("main", main_name, "maroon"),
+        ("other", other_name, "orange"),
+    ]:
+        lons, lats = outlines[key]
+        if len(lons) > 0:
+            traces.append(lines_trace(lons, lats, name, color))
+
+    return traces
+
+
 def clip_dataset(ds, polygons):
     ds = ds.rio.set_nodata(0)
     ds = ds.rio.clip(polygons)
@@ -150,23 +729,10 @@ def clip_dataset(ds, polygons):
 
 
 def load_plot_datasets(bbox_mollweide, path_cache, clip=False):
-    smod = load_or_download(
-        bbox_mollweide,
-        "SMOD",
-        data_path=path_cache,
-        resolution=1000,
-    )
-    built = load_or_download(
-        bbox_mollweide,
-        "BUILT_S",
-        data_path=path_cache,
-        resolution=100,
-    )
-    pop = load_or_download(
+    smod, built, pop = load_or_download_many(
         bbox_mollweide,
-        "POP",
+        [("SMOD", 1000), ("BUILT_S", 100), ("POP", 100)],
         data_path=path_cache,
-        resolution=100,
     )
 
     if clip:
@@ -196,57 +762,282 @@ def smod_polygons(smod, centroid):
     """
 
     # Get DoU lvl 1 representation (1: rural, 2: cluster, 3: center)
-    smod_lvl_1 = smod // 10
-
-    smod_centers = (smod_lvl_1 == 3).astype(smod.dtype)
-    smod_clusters = (smod_lvl_1 > 1).astype(smod.dtype)
+    smod_lvl_1 = smod.values // 10
 
+    years = smod["band"].values
+    n_years, height, width = smod_lvl_1.shape
     transform = smod.rio.transform()
 
-    dict_list = []
-    for year in smod["band"].values:
-        centers = rio.features.shapes(
-            smod_centers.sel(band=year).values, connectivity=8, transform=transform
+    # Label every year in a single pass, connecting the 8 neighbours of
+    # each cell within a year but never across years
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = True
+
+    # Cell containing the centroid, whose labels are the main polygons
+    col, row = ~transform * (centroid.x, centroid.y)
+    row, col = int(np.floor(row)), int(np.floor(col))
+    has_main = 0 <= row < height and 0 <= col < width
+
+    gdf_list = []
+    for smod_class, mask in [(3, smod_lvl_1 == 3), (2, smod_lvl_1 > 1)]:
+        labels, _ = label(mask, structure=structure)
+        labels = labels.astype("int32")
+
+        # Polygonize all years at once, stacked vertically, in pixel
+        # coordinates. Labels are unique, so years never merge.
+        labels_2d = labels.reshape(n_years * height, width)
+        geoms, values = ru.polygons_from_shapes(
+            rio.features.shapes(labels_2d, mask=labels_2d > 0, connectivity=8)
         )
-        clusters = rio.features.shapes(
-            smod_clusters.sel(band=year).values, connectivity=8, transform=transform
+
+        # Labels are numbered in scan order, so each year's labels follow
+        # the previous year's
+        last_label = np.maximum.accumulate(labels.reshape(n_years, -1).max(axis=1))
+        year_idx = np.searchsorted(last_label, values)
+
+        # Move each vertex back to its year's rows and to the grid's CRS
+        coords, index = shapely.get_coordinates(geoms, return_index=True)
+        cols = coords[:, 0]
+        rows = coords[:, 1] - year_idx[index] * height
+        coords = np.column_stack(
+            [
+                cols * transform.a + rows * transform.b + transform.c,
+                cols * transform.d + rows * transform.e + transform.f,
+            ]
         )
+        geoms = shapely.set_coordinates(geoms, coords)
 
-        center_list = [shape(f[0]) for f in centers if f[1] > 0]
-        cluster_list = [shape(f[0]) for f in clusters if f[1] > 0]
-
-        center_dicts = [
-            {
-                "class": 3,
-                "year": year,
-                "is_main": centroid.within(center),
-                "geometry": center,
-            }
-            for center in center_list
-        ]
-        cluster_dicts = [
-            {
-                "class": 2,
-                "year": year,
-                "is_main": centroid.within(cluster),
-                "geometry": cluster,
-            }
-            for cluster in cluster_list
-        ]
-        dict_list += center_dicts
-        dict_list += cluster_dicts
-
-    smod_polygons = gpd.GeoDataFrame(dict_list, crs=smod.rio.crs)
+        if has_main:
+            main_labels = labels[:, row, col]
+            is_main = values == main_labels[year_idx]
+        else:
+            is_main = np.zeros(len(values), dtype=bool)
+
+        gdf_list.append(
+            gpd.GeoDataFrame(
+                {
+                    "class": np.full(len(values), smod_class, dtype="int64"),
+                    "year": years[year_idx],
+                    "is_main": is_main,
+                },
+                geometry=gpd.GeoSeries(geoms),
+                crs=smod.rio.crs,
+            )
+        )
+
+    # Centers before clusters within each year
+    smod_polygons = pd.concat(gdf_list, ignore_index=True)
+    smod_polygons = smod_polygons.sort_values("year", kind="stable")
+    smod_polygons = smod_polygons.reset_index(drop=True)
 
     return smod_polygons
 
 
-def built_s_polygons(built):
-    """Returns a polygon per pixel for GHS BUILT rasters."""
+def get_artifact_key(smod, centroid):
+    """Returns a short key identifying the artifacts derived from an SMOD
+    stack and a centroid: its grid, years and the centroid's position."""
+
+    key = (
+        tuple(smod.shape),
+        tuple(smod.rio.transform())[:6],
+        tuple(int(year) for year in smod.coords["band"].values),
+        round(centroid.x),
+        round(centroid.y),
+    )
+
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def _memo_get(key):
+    # Stored values are never modified, they can be copied out of the lock
+    with _memo_lock:
+        if key not in _memo:
+            return None
+        _memo.move_to_end(key)
+        value = _memo[key]
+
+    return value.copy()
+
+
+def _memo_put(key, value):
+    value = value.copy()
+    with _memo_lock:
+        _memo[key] = value
+        _memo.move_to_end(key)
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+
+
+def first_epoch(raster, thresh):
+    """Returns a raster with the first epoch in which each pixel of a
+    stack is above thresh, computed in a single pass.
+
+    Epochs are coded as the position of the band in the stack plus one
+    (1 for the first band), and 0 marks pixels never above thresh.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Stack with a band per epoch.
+    thresh : float
+        Threshold, pixels strictly above it count.
+
+    Returns
+    -------
+    first : xarray.DataArray
+        Single band uint8 DataArray with the coded epochs.
+    """
+
+    above = raster.values > thresh
+    first = np.argmax(above, axis=0).astype("uint8") + 1
+    first[~above.any(axis=0)] = 0
+
+    first = raster.isel(band=0, drop=True).copy(data=first)
+    first = first.rio.write_nodata(0)
+
+    return first
+
+
+def load_or_get_first_epoch(raster, thresh, name, path_cache=None, force=False):
+    """Returns the first epoch raster of first_epoch, cached in memory and,
+    if path_cache is given, as a GeoTIFF in the city cache.
+
+    Parameters
+    ----------
+    raster : xarray.DataArray
+        Stack with a band per epoch.
+    thresh : float
+        Threshold, pixels strictly above it count.
+    name : str
+        Name of the data set in raster, used in the cache's file name.
+    path_cache : Path
+        Path of the city cache. If None, the raster is only kept in memory.
+    force : bool
+        Recompute the raster even if cached.
+
+    Returns
+    -------
+    first : xarray.DataArray
+        Single band uint8 DataArray with the coded epochs.
+    """
+
+    key = (
+        tuple(raster.shape),
+        tuple(raster.rio.transform())[:6],
+        tuple(int(year) for year in raster.coords["band"].values),
+        float(thresh),
+    )
+    key = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    memo_key = ("first_epoch", name, str(path_cache), key)
+    if not force:
+        first = _memo_get(memo_key)
+        if first is not None:
+            return first
+
+    if path_cache is None:
+        first = first_epoch(raster, thresh)
+    else:
+        fpath = Path(path_cache) / f"first_epoch_{name}_{key}.tif"
+        with single_flight(fpath):
+            if fpath.exists() and not force:
+                first = rxr.open_rasterio(fpath).squeeze("band", drop=True).load()
+            else:
+                first = first_epoch(raster, thresh)
+                with atomic_path(fpath) as tmp_path:
+                    first.rio.to_raster(tmp_path)
+
+    _memo_put(memo_key, first)
+
+    return first
+
+
+def load_or_get_smod_polygons(smod, centroid, path_cache=None, force=False):
+    """Returns the SMOD polygons of smod_polygons, cached in memory and,
+    if path_cache is given, as GeoParquet in the city cache.
+
+    Parameters
+    ----------
+    smod : xarray.DataArray
+        DataArray with SMOD raster data.
+    centroid : shapely.Point
+        Centroid of the principal urban center, in Mollweide.
+    path_cache : Path
+        Path of the city cache. If None, polygons are only kept in memory.
+    force : bool
+        Recompute the polygons even if cached.
+
+    Returns
+    -------
+    smod_polygons : GeoDataFrame
+        GeoDataFrame with polygons for urban clusters and centers.
+    """
+
+    key = get_artifact_key(smod, centroid)
+    memo_key = ("smod_polygons", str(path_cache), key)
+    if not force:
+        smod_gdf = _memo_get(memo_key)
+        if smod_gdf is not None:
+            return smod_gdf
+
+    if path_cache is None:
+        smod_gdf = smod_polygons(smod, centroid)
+    else:
+        fpath = Path(path_cache) / f"smod_polygons_{key}.parquet"
+        with single_flight(fpath):
+            if fpath.exists() and not force:
+                smod_gdf = gpd.read_parquet(fpath)
+            else:
+                smod_gdf = smod_polygons(smod, centroid)
+                with atomic_path(fpath) as tmp_path:
+                    smod_gdf.to_parquet(tmp_path)
+
+    _memo_put(memo_key, smod_gdf)
+
+    return smod_gdf
+
+
+def built_s_polygons(built, dissolve=False, fraction_step=0.05):
+    """Returns a polygon per pixel for GHS BUILT rasters.
+
+    Parameters
+    ----------
+    built : xarray.DataArray
+        DataArray with GHS BUILT_S raster data.
+    dissolve : bool
+        If True, built fractions are rounded up to multiples of
+        fraction_step and adjacent pixels of the same year and fraction are
+        merged into a single polygon. The b_area column is then dropped.
+    fraction_step : float
+        Step of the rounded built fractions when dissolving.
+
+    Returns
+    -------
+    built_gdf : GeoDataFrame
+        GeoDataFrame with year, fraction and geometry columns, and the
+        built area of each pixel if not dissolved.
+    """
 
     resolution = built.rio.resolution()
     pixel_area = abs(np.prod(resolution))
 
+    if dissolve:
+        transform = built.rio.transform()
+        gdf_list = []
+        for year in built.coords["band"].values:
+            steps = np.ceil(built.sel(band=year).values / pixel_area / fraction_step)
+            steps = steps.astype("int32")
+            geoms, values = ru.polygons_from_shapes(
+                rio.features.shapes(steps, mask=steps > 0, transform=transform)
+            )
+            gdf_list.append(
+                gpd.GeoDataFrame(
+                    {"year": year, "fraction": values * fraction_step},
+                    geometry=gpd.GeoSeries(geoms),
+                    crs=built.rio.crs,
+                )
+            )
+        return pd.concat(gdf_list, ignore_index=True)
+
     built_df = built.to_dataframe(name="b_area").reset_index()
     built_df = built_df.rename(columns={"band": "year"})
     built_df = built_df.drop(columns="spatial_ref")
@@ -254,7 +1045,7 @@ def built_s_polygons(built):
     built_df = built_df[built_df.b_area > 0].reset_index(drop=True)
 
     built_df["fraction"] = built_df.b_area / pixel_area
-    built_df["geometry"] = built_df.apply(ru.row2cell, res_xy=resolution, axis=1)
+    built_df["geometry"] = ru.cells_from_xy(built_df.x, built_df.y, resolution)
 
     built_gdf = gpd.GeoDataFrame(built_df, crs=built.rio.crs).drop(columns=["x", "y"])
 
@@ -263,7 +1054,8 @@ def built_s_polygons(built):
 
 def plot_built_poly(built_gdf, bbox_latlon, year=2020):
     """Plots a map with built information for year with polygons.
-    May be slow and memory heavy."""
+    May be slow and memory heavy, unless built_gdf was created with
+    built_s_polygons(built, dissolve=True)."""
 
     west, south, east, north = bbox_latlon.bounds
 
@@ -291,7 +1083,15 @@ def plot_built_poly(built_gdf, bbox_latlon, year=2020):
     return Map
 
 
-def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0.2, language="es"):
+def plot_built_agg_img(
+    smod,
+    built,
+    bbox_mollweide,
+    centroid_mollweide,
+    thresh=0.2,
+    language="es",
+    path_cache=None,
+):
     """Plots historic built using an image overlay."""
 
     translations = {
@@ -327,62 +1127,22 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
         "2015",
         "2020",
     ]
-    years_uint8 = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], dtype="uint8")
-
-    resolution = built.rio.resolution()
-    pixel_area = abs(np.prod(resolution))
-
-    # Create a density array
-    # Only densities can be safely reprojected
-    built = built / pixel_area
-
-    # Reproject
-    built.rio.set_nodata(0)
-    built = built.rio.reproject("EPSG:4623")
-
-    # Create a yearly coded binary built array
-    built_bin = (built > thresh).astype("uint8")
-    built_bin *= years_uint8[:, None, None]
-    built_bin.values[built_bin.values == 0] = 200
-
-    # Aggregate yearly binary built data
-    # Keep earliest year of observed urbanization
-    built_bin_agg = np.min(built_bin, axis=0)
-    built_bin_agg.values[built_bin_agg == 200] = 0
-
-    # Create high resolution raster in lat-lon
-
-    # Create array to hold colorized image
-    built_img = np.zeros((*built_bin_agg.shape, 4), dtype="uint8")
 
     # Set colormap
     colors_rgba = [plt.cm.get_cmap("cividis", 10)(i) for i in range(10)]
-    colors = (np.array(colors_rgba) * 255).astype("uint8")
-    cmap = {y: c for y, c in zip(years_uint8, colors)}
     cmap_cat = {y: mpl.colors.rgb2hex(c) for y, c in zip(years, colors_rgba)}
 
-    # Set colors manually on image array
-    for year, color in cmap.items():
-        mask = built_bin_agg == year
-        built_img[mask] = color
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = built_bin_agg.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
-
-    # Create Image object (memory haevy)
-    img = ImageOps.flip(Image.fromarray(built_img))
-
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
+    if use_tiles(path_cache):
+        # Tiles are rendered from the full resolution stack in the cache
+        bounds = built.rio.transform_bounds("EPSG:4326")
+        layer = overlay_layer(get_tile_url(path_cache, "built_agg", thresh=thresh))
+    else:
+        key = ("built_agg", str(path_cache), thresh, get_grid_key(built))
+        img, bounds = ur.load_or_render(
+            key, lambda: render_built_agg(built, thresh, path_cache)
         )
+        layer = overlay_layer(img, image_coordinates(bounds))
+    lonmin, latmin, lonmax, latmax = bounds
 
     dummy_df = pd.DataFrame({"lat": [0] * 10, "lon": [0] * 10, "Year": years})
     fig = px.scatter_mapbox(
@@ -402,72 +1162,24 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
         mapbox_center={"lat": (latmin + latmax) / 2, "lon": (lonmin + lonmax) / 2},
     )
 
-    # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
-    clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for _, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
+    # Outlines of urban clusters
+    fig.add_traces(
+        cluster_outline_traces(
+            smod,
+            centroid_mollweide,
+            translations[language]["Central Zone"],
+            translations[language]["Peripheral Zones"],
+            path_cache,
         )
-
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
-
-    # Add trace of bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
     )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
+
+    # Outline of the analysis zone
+    fig.add_trace(
+        outline_trace(bbox_mollweide, translations[language]["Analysis Zone"])
     )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
 
     fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
+        mapbox_layers=[layer]
     )
 
     fig.add_annotation(
@@ -482,85 +1194,50 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
     return fig
 
 
-def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
+def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache=None):
     built.rio.set_nodata(0)
     pop.rio.set_nodata(0)
 
-    smod_gdf = smod_polygons(smod, centroid_mollweide)
+    smod_gdf = load_or_get_smod_polygons(smod, centroid_mollweide, path_cache)
     smod_gdf["Area"] = smod_gdf.area
 
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
 
     main_cluster = clusters_gdf[clusters_gdf.is_main]
 
-    # Total built-up area and pop per year
-    # Built raster contains squared meters
-    total_built = built.sum(axis=(1, 2)).values
-    total_pop = pop.sum(axis=(1, 2)).values
-
     # Built and pop within center and cluster
     years = smod.coords["band"].values
-    cluster_built = []
-    cluster_pop = []
-    cluster_built_all = []
-    cluster_pop_all = []
 
+    # Label pixels within the main cluster (2) and other clusters (1)
+    # of each year on the 100 m grid, and sum every variable within each
+    # label in a single pass over all years. Years without a main cluster
+    # are left unlabeled, so their cluster sums are zero.
+    main_years = set(main_cluster.year.values)
+    shapes_list = []
     for year in years:
-        # Check if main cluster is empty
-        if main_cluster[main_cluster.year == year].empty:
-            cluster_built.append(0)
-            cluster_pop.append(0)
-            cluster_built_all.append(0)
-            cluster_pop_all.append(0)
-        else:
-            # Main cluster and center
-            cluster = main_cluster[main_cluster.year == year].geometry.iloc[0]
-
-            # All clusters and centers
-            cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
-
-            # Series for main cluster and center
-            cluster_built.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=built.rio.crs)
-                    .values
-                )
-            )
-
-            cluster_pop.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=pop.rio.crs)
-                    .values
-                )
-            )
+        shapes = []
+        if year in main_years:
+            df_year = clusters_gdf[clusters_gdf.year == year]
+            shapes = [
+                (geom, 2 if is_main else 1)
+                for geom, is_main in zip(df_year.geometry, df_year.is_main)
+            ]
+        shapes_list.append(shapes)
+    labels = ru.rasterize_labels(shapes_list, built.shape[1:], built.rio.transform())
 
-            # Series for ALL clusters and centers
-            cluster_built_all.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=built.rio.crs)
-                    .values
-                )
-            )
+    # Built raster contains squared meters
+    built_sums = ru.zonal_sums(labels, built.sel(band=years).values, 3)
+    pop_sums = ru.zonal_sums(labels, pop.sel(band=years).values, 3)
 
-            cluster_pop_all.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=pop.rio.crs)
-                    .values
-                )
-            )
+    # Total built-up area and pop per year
+    total_built = built_sums.sum(axis=1)
+    total_pop = pop_sums.sum(axis=1)
 
-    cluster_built = np.array(cluster_built)
-    cluster_pop = np.array(cluster_pop)
-    cluster_built_all = np.array(cluster_built_all)
-    cluster_pop_all = np.array(cluster_pop_all)
+    # Series for main cluster and for ALL clusters
+    cluster_built = built_sums[:, 2]
+    cluster_pop = pop_sums[:, 2]
+    cluster_built_all = built_sums[:, 1] + built_sums[:, 2]
+    cluster_pop_all = pop_sums[:, 1] + pop_sums[:, 2]
 
     # Identify year that are not in main, i.e. years without a main cluster
     years_not_int_main = set(years) - set(main_cluster.year.values)
@@ -615,13 +1292,48 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
         }
     )
 
-    df.to_csv(path_cache / "urban_growth.csv")
+    return df
+
+
+def load_or_get_urb_growth_df(
+    smod, built, pop, centroid_mollweide, path_cache, force=False
+):
+    """Returns the urban growth table of get_urb_growth_df, cached in
+    memory and as Parquet in the city cache."""
+
+    key = get_artifact_key(smod, centroid_mollweide)
+    memo_key = ("urban_growth", str(path_cache), key)
+    if not force:
+        df = _memo_get(memo_key)
+        if df is not None:
+            return df
+
+    fpath = Path(path_cache) / f"urban_growth_{key}.parquet"
+    with single_flight(fpath):
+        if fpath.exists() and not force:
+            df = pd.read_parquet(fpath)
+        else:
+            df = get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache)
+            with atomic_path(fpath) as tmp_path:
+                df.to_parquet(tmp_path)
+
+    _memo_put(memo_key, df)
 
     return df
 
 
-def plot_smod_clusters(smod, bbox_latlon, feature="clusters", language='es'):
-    
+def plot_smod_clusters(
+    smod,
+    bbox_latlon,
+    feature="clusters",
+    language="es",
+    dissolve=True,
+    path_cache=None,
+):
+    """Plots the first year each SMOD pixel became an urban cluster or
+    center. If dissolve is True, adjacent pixels with the same year are
+    merged into a single polygon, otherwise a polygon per pixel is drawn."""
+
     translations = {
         "es": {"Year": "Año"},
         "en": {"Year": "Year"},
@@ -636,20 +1348,36 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters", language='es'):
         print("Feature must be either clusters or centers.")
         assert False
 
-    smod_lvl_1 = smod // 10
-
-    smod_lvl_1_df = smod_lvl_1.to_dataframe(name="smod").reset_index()
-    smod_lvl_1_df = smod_lvl_1_df.drop(columns="spatial_ref")
-
-    df = smod_lvl_1_df[smod_lvl_1_df.smod >= c_code].drop(columns="smod")
-
-    df = df.groupby(["x", "y"]).min().reset_index()
-    df = df.rename(columns={"band": translations[language]["Year"]})
-    df = df.sort_values(translations[language]["Year"]).reset_index(drop=True)
+    # First year each pixel reached c_code (1: rural, 2: cluster, 3: center)
+    first = load_or_get_first_epoch(smod, c_code * 10 - 1, "SMOD", path_cache)
+    smod_years = smod.coords["band"].values
+
+    if dissolve:
+        geoms, codes = ru.polygons_from_shapes(
+            rio.features.shapes(
+                first.values,
+                mask=first.values > 0,
+                connectivity=4,
+                transform=first.rio.transform(),
+            )
+        )
+    else:
+        rows, cols = np.nonzero(first.values)
+        codes = first.values[rows, cols]
+        geoms = ru.cells_from_xy(
+            first.x.values[cols], first.y.values[rows], smod.rio.resolution()
+        )
 
-    df["geometry"] = df.apply(ru.row2cell, res_xy=smod.rio.resolution(), axis=1)
+    df = pd.DataFrame(
+        {
+            translations[language]["Year"]: smod_years[codes.astype(int) - 1],
+            "geometry": geoms,
+        }
+    )
+    df = df.sort_values(translations[language]["Year"], kind="stable")
+    df = df.reset_index(drop=True)
 
-    gdf = gpd.GeoDataFrame(df.drop(columns=["x", "y"]), crs=smod.rio.crs)
+    gdf = gpd.GeoDataFrame(df, crs=smod.rio.crs)
 
     gdf[translations[language]["Year"]] = gdf[translations[language]["Year"]].astype(str)
 
@@ -711,7 +1439,14 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters", language='es'):
 
 
 def plot_built_year_img(
-    smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, year=2020, language = "es"
+    smod,
+    built,
+    bbox_latlon,
+    bbox_mollweide,
+    centroid_mollweide,
+    year=2020,
+    language="es",
+    path_cache=None,
 ):
     """Plots built for year using an image overlay."""
 
@@ -742,33 +1477,15 @@ def plot_built_year_img(
         }
     }
 
-    resolution = built.rio.resolution()
-    pixel_area = abs(np.prod(resolution))
-
-    # Select specific year and transform into density
-    # Only densitities can be safely reprojected
-    built = built.sel(band=year) / pixel_area
-    built.rio.set_nodata(0)
-
-    # Reprojecto to lat lon
-    built = built.rio.reproject(dst_crs=4326)
-
-    # Get colorized image.
-    cmap = plt.get_cmap("cividis").copy()
-    colorized = cmap(built)
-    mask = built.values == 0
-    colorized[mask] = (0, 0, 0, 0)
-    colorized = np.uint8(colorized * 255)
-    img = ImageOps.flip(Image.fromarray(colorized))
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = built.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
+    if use_tiles(path_cache):
+        # Tiles are rendered from the full resolution stack in the cache
+        bounds = built.sel(band=year).rio.transform_bounds("EPSG:4326")
+        layer = overlay_layer(get_tile_url(path_cache, "built_year", year=year))
+    else:
+        key = ("built_year", str(path_cache), year, get_grid_key(built))
+        img, bounds = ur.load_or_render(key, lambda: render_built_year(built, year))
+        layer = overlay_layer(img, image_coordinates(bounds))
+    lonmin, latmin, lonmax, latmax = bounds
 
     # Create figure
     west, south, east, north = bbox_latlon.bounds
@@ -792,80 +1509,25 @@ def plot_built_year_img(
         margin={"r": 0, "t": 30, "l": 0, "b": 0}, height=HEIGHT, legend_orientation="h"
     )
 
-    # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
-    clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for i, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
+    # Outlines of urban clusters
+    fig.add_traces(
+        cluster_outline_traces(
+            smod,
+            centroid_mollweide,
+            translations[language]["Central Zone"],
+            translations[language]["Peripheral Zones"],
+            path_cache,
         )
-
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
-
-    # Add trace of bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
-    )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
     )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
 
-
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    # Outline of the analysis zone
+    fig.add_trace(
+        outline_trace(bbox_mollweide, translations[language]["Analysis Zone"])
+    )
 
     fig.update_layout(coloraxis_colorbar_orientation="h")
     fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
+        mapbox_layers=[layer]
     )
 
     fig.add_annotation(
@@ -880,7 +1542,15 @@ def plot_built_year_img(
     return fig
 
 
-def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020, language = "es"):
+def plot_pop_year_img(
+    smod,
+    pop,
+    bbox_mollweide,
+    centroid_mollweide,
+    year=2020,
+    language="es",
+    path_cache=None,
+):
     
     translations = {
     "es": {
@@ -903,45 +1573,18 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020,
     }
 }
     
-    resolution = pop.rio.resolution()
-    pixel_area = abs(np.prod(resolution)) / 1e6
-
-    # Select specific year and transform into density
-    # Only densitities can be safely reprojected
-    pop = pop.sel(band=year) / pixel_area
-    pop.rio.set_nodata(0)
-
-    # Reprojecto to lat lon
-    pop = pop.rio.reproject(dst_crs=4326)
-
-    # Get back counts
-    pop = pop * ru.get_area_grid(pop, "km")
-
-    # Normalize values for colormap
-    n_classes = 7
-    pop_min = np.unique(pop)[1]
-    bounds = np.array(
-        [-1, pop_min / 2.0, 5.5, 20.5, 100.5, 300.5, 500.5, 1000.5, 10000]
-    )
-    norm = mpl.colors.BoundaryNorm(boundaries=bounds, ncolors=n_classes + 1)
-    pop_norm = norm(pop).data / n_classes
-
-    # Get colorized image.
+    n_classes = len(ur.POP_BOUNDS)
     cmap = plt.get_cmap("cividis").copy()
-    colorized = cmap(pop_norm)
-    mask = pop_norm == 0
-    colorized[mask] = (0, 0, 0, 0)
-    colorized = np.uint8(colorized * 255)
-    img = ImageOps.flip(Image.fromarray(colorized))
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = pop.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
+
+    if use_tiles(path_cache):
+        # Tiles are rendered from the full resolution stack in the cache
+        bounds = pop.sel(band=year).rio.transform_bounds("EPSG:4326")
+        layer = overlay_layer(get_tile_url(path_cache, "pop_year", year=year))
+    else:
+        key = ("pop_year", str(path_cache), year, get_grid_key(pop))
+        img, bounds = ur.load_or_render(key, lambda: render_pop_year(pop, year))
+        layer = overlay_layer(img, image_coordinates(bounds))
+    lonmin, latmin, lonmax, latmax = bounds
 
     mid_vals = ["3", "10", "50", "200", "400", "750", "2000"]
     cls_names = [
@@ -979,78 +1622,24 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020,
         margin={"r": 0, "t": 30, "l": 0, "b": 0}, height=HEIGHT, legend_orientation="h"
     )
 
-    # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
-    clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for i, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
+    # Outlines of urban clusters
+    fig.add_traces(
+        cluster_outline_traces(
+            smod,
+            centroid_mollweide,
+            translations[language]["Central Zone"],
+            translations[language]["Peripheral Zones"],
+            path_cache,
         )
-
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
-
-    # Agregar traza del bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
     )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
-    )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
 
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    # Outline of the analysis zone
+    fig.add_trace(
+        outline_trace(bbox_mollweide, translations[language]["Analysis Zone"])
+    )
 
     fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
+        mapbox_layers=[layer]
     )
 
     fig.add_annotation(
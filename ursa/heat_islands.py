@@ -10,6 +10,7 @@ import ursa.world_cover as wc
 
 from typing import Tuple, List
 from ursa.constants import TEMP_CAT_MAP, TEMP_NAMES
+from ursa.utils.cache_lock import atomic_path, single_flight
 from ursa.utils.date import date_format
 from ursa.utils.raster import bbox_to_ee
 
@@ -96,13 +97,14 @@ def get_temps(lst, masks):
 
 def load_or_get_temps(lst, masks, path_cache):
     fpath = path_cache / "temperatures.json"
-    if fpath.exists():
-        with open(fpath, "r") as f:
-            temps = json.load(f)
-    else:
-        temps = get_temps(lst, masks)
-        with open(path_cache / "temperatures.json", "w") as f:
-            json.dump(temps, f)
+    with single_flight(fpath):
+        if fpath.exists():
+            with open(fpath, "r") as f:
+                temps = json.load(f)
+        else:
+            temps = get_temps(lst, masks)
+            with atomic_path(fpath) as tmp_path, open(tmp_path, "w") as f:
+                json.dump(temps, f)
 
     return temps
 
@@ -192,11 +194,13 @@ def get_temperature_areas(img_cat, masks, bbox):
 
 def load_or_get_t_areas(bbox_ee, img_cat, masks, path_cache):
     fpath = path_cache / "temp_areas.csv"
-    if fpath.exists():
-        df = pd.read_csv(fpath, index_col="clase")
-    else:
-        df = get_temperature_areas(img_cat, masks, bbox_ee)
-        df.to_csv(path_cache / "temp_areas.csv")
+    with single_flight(fpath):
+        if fpath.exists():
+            df = pd.read_csv(fpath, index_col="clase")
+        else:
+            df = get_temperature_areas(img_cat, masks, bbox_ee)
+            with atomic_path(fpath) as tmp_path:
+                df.to_csv(tmp_path)
     return df
 
 
@@ -250,12 +254,14 @@ def get_land_usage_dataframe(bbox_ee, img_cat, lc):
 
 def load_or_get_land_usage_df(bbox_ee, img_cat, path_cache):
     fpath = path_cache / "land_cover_by_temp.csv"
-    if fpath.exists():
-        df = pd.read_csv(fpath)
-    else:
-        lc, _ = wc.get_cover_and_masks(bbox_ee, img_cat.projection())
-        df = get_land_usage_dataframe(bbox_ee, img_cat, lc)
-        df.to_csv(path_cache / "land_cover_by_temp.csv", index=False)
+    with single_flight(fpath):
+        if fpath.exists():
+            df = pd.read_csv(fpath)
+        else:
+            lc, _ = wc.get_cover_and_masks(bbox_ee, img_cat.projection())
+            df = get_land_usage_dataframe(bbox_ee, img_cat, lc)
+            with atomic_path(fpath) as tmp_path:
+                df.to_csv(tmp_path, index=False)
     return df
 
 
@@ -353,28 +359,31 @@ def load_or_get_radial_distributions(
     fpath_f = path_cache / "radial_function.csv"
     fpath_lc = path_cache / "radial_lc.csv"
 
-    if fpath_f.exists() and fpath_lc.exists():
-        df_f = pd.read_csv(fpath_f)
-        df_lc = pd.read_csv(fpath_lc, index_col="x")
-    else:
-        bbox_ee = bbox_to_ee(bbox_latlon)
-        
-        lst, proj = get_lst(bbox_ee, start_date, end_date)
-        lc, masks = wc.get_cover_and_masks(bbox_ee, proj)
+    with single_flight(fpath_f, fpath_lc):
+        if fpath_f.exists() and fpath_lc.exists():
+            df_f = pd.read_csv(fpath_f)
+            df_lc = pd.read_csv(fpath_lc, index_col="x")
+        else:
+            bbox_ee = bbox_to_ee(bbox_latlon)
 
-        temps = load_or_get_temps(lst, masks, path_cache)
-        rural_lst_mean = temps["rural"]["mean"]
+            lst, proj = get_lst(bbox_ee, start_date, end_date)
+            lc, masks = wc.get_cover_and_masks(bbox_ee, proj)
 
-        unwanted_mask = masks["unwanted"]
+            temps = load_or_get_temps(lst, masks, path_cache)
+            rural_lst_mean = temps["rural"]["mean"]
 
-        suhi = lst.subtract(rural_lst_mean)
-        suhi = suhi.updateMask(unwanted_mask)
-    
-        df_lc = get_radial_lc(bbox_latlon, uc_latlon, lc)
-        df_f = get_radial_f(bbox_latlon, uc_latlon, suhi)
+            unwanted_mask = masks["unwanted"]
 
-        df_lc.to_csv(fpath_lc)
-        df_f.to_csv(fpath_f)
+            suhi = lst.subtract(rural_lst_mean)
+            suhi = suhi.updateMask(unwanted_mask)
+
+            df_lc = get_radial_lc(bbox_latlon, uc_latlon, lc)
+            df_f = get_radial_f(bbox_latlon, uc_latlon, suhi)
+
+            with atomic_path(fpath_lc) as tmp_path:
+                df_lc.to_csv(tmp_path)
+            with atomic_path(fpath_f) as tmp_path:
+                df_f.to_csv(tmp_path)
 
     return df_f, df_lc
 
@@ -408,7 +417,7 @@ def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_ca
     smod = ghsl.load_or_download(
         bbox_mollweide, "SMOD", data_path=path_cache, resolution=1000
     )
-    smod_gdf = ghsl.smod_polygons(smod, uc_mollweide_centroid)
+    smod_gdf = ghsl.load_or_get_smod_polygons(smod, uc_mollweide_centroid, path_cache)
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
     main_cluster = clusters_gdf[clusters_gdf.is_main]
 
@@ -429,7 +438,8 @@ def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_ca
         {"roofs": roof_area, "urban": urban_area, "roads": road_lenght}, index=[0]
     )
 
-    df.to_csv(path_cache / "mitigation_areas.csv", index=False)
+    with atomic_path(path_cache / "mitigation_areas.csv") as tmp_path:
+        df.to_csv(tmp_path, index=False)
 
     print("Done.")
 
@@ -440,12 +450,13 @@ def load_or_get_mit_areas_df(
     bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache, force=False
 ):
     fpath = path_cache / "mitigation_areas.csv"
-    if fpath.exists() and not force:
-        df = pd.read_csv(fpath)
-    else:
-        df = get_mit_areas_df(
-            bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache
-        )
+    with single_flight(fpath):
+        if fpath.exists() and not force:
+            df = pd.read_csv(fpath)
+        else:
+            df = get_mit_areas_df(
+                bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache
+            )
     return df
 
 
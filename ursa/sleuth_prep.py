@@ -15,18 +15,32 @@ import xarray as xr
 from geocube.api.core import make_geocube
 from rasterio.enums import Resampling
 from scipy.spatial import KDTree
+from ursa.utils.cache_lock import atomic_path, single_flight
+from ursa.utils.subregion import find_parent_file
+
+# Dtypes of the SLEUTH inputs with ghsl.COMPACT_DTYPES, every value but
+# years lies in 0-100
+COMPACT_DTYPES = {
+    "years": "uint16",
+    "urban": "uint8",
+    "roads": "uint8",
+    "slope": "uint8",
+    "excluded": "uint8",
+}
 
 
 def load_or_prep_rasters(bbox_mollweide, path_cache):
-    all_exist = True
-    for path in ["urban", "roads", "slope", "excluded", "years"]:
-        full_path = path_cache / f"{path}.npy"
-        all_exist &= full_path.exists()
+    # attributes.json is written last, it guards the whole set of inputs
+    with single_flight(path_cache / "attributes.json"):
+        all_exist = True
+        for path in ["urban", "roads", "slope", "excluded", "years"]:
+            full_path = path_cache / f"{path}.npy"
+            all_exist &= full_path.exists()
 
-    all_exist &= (path_cache / "attributes.json").exists()
+        all_exist &= (path_cache / "attributes.json").exists()
 
-    if not all_exist:
-        prep_rasters(bbox_mollweide, path_cache)
+        if not all_exist:
+            prep_rasters(bbox_mollweide, path_cache)
 
     return True
 
@@ -63,7 +77,8 @@ def prep_rasters(bbox_mollweide, path_cache):
     # Historic urbanization, obtained from GHSL + DoU processing
     # Extract last 20 years or urbanization for 5 calibration points
     dou_xr = dou.load_or_process_dou(bbox_mollweide, path_cache)
-    dou_xr = dou_xr.astype("int32")
+    if not ghsl.COMPACT_DTYPES:
+        dou_xr = dou_xr.astype("int32")
     dou_xr.name = "urban"
     dou_xr = dou_xr.rename({"band": "year"})
     urban_years = dou_xr.coords["year"].values
@@ -87,11 +102,18 @@ def prep_rasters(bbox_mollweide, path_cache):
     geocube = bbox_to_geocube(bbox_latlon, path_cache, dou_xr)
     roads, *_ = load_roads(geocube)
 
-    np.save(path_cache / "years", urban_years)
-    np.save(path_cache / "urban", dou_xr.values)
-    np.save(path_cache / "roads", roads.values)
-    np.save(path_cache / "slope", slope_xr.values)
-    np.save(path_cache / "excluded", excluded_xr.values)
+    arrays = {
+        "years": urban_years,
+        "urban": dou_xr.values,
+        "roads": roads.values,
+        "slope": slope_xr.values,
+        "excluded": excluded_xr.values,
+    }
+    for name, array in arrays.items():
+        if ghsl.COMPACT_DTYPES:
+            array = array.astype(COMPACT_DTYPES[name], copy=False)
+        with atomic_path(path_cache / f"{name}.npy") as tmp_path:
+            np.save(tmp_path, array)
 
     attr_dict = dict(
         years=[int(year) for year in dou_xr.year.values],
@@ -101,8 +123,9 @@ def prep_rasters(bbox_mollweide, path_cache):
         crs=dou_xr.rio.crs.to_string(),
     )
 
-    with open(path_cache / "attributes.json", "w", encoding="utf8") as f:
-        json.dump(attr_dict, f)
+    with atomic_path(path_cache / "attributes.json") as tmp_path:
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(attr_dict, f)
 
 
 def load_excluded(bbox_ee, bbox_mollweide, path_cache, raster_to_match):
@@ -130,13 +153,12 @@ def load_excluded(bbox_ee, bbox_mollweide, path_cache, raster_to_match):
         bbox_mollweide, "LAND", data_path=path_cache, resolution=100
     ).squeeze()
     cell_area = land_xr.rio.resolution()[0] ** 2
-    land_xr = land_xr / cell_area
-    water_xr = 1 - land_xr
-    # Binarize at 50% trehsold
-    water_xr = (water_xr > 0.5).astype("int32")
+    mask_dtype = "uint8" if ghsl.COMPACT_DTYPES else "int32"
+    # Water fraction is 1 - land fraction, binarize at 50% trehsold
+    water_xr = (land_xr < 0.5 * cell_area).astype(mask_dtype)
 
     # Build excluded by combining water +  protected
-    excluded = np.logical_or(water_xr, protected_xr).astype("int32")
+    excluded = np.logical_or(water_xr, protected_xr).astype(mask_dtype)
 
     orig_attrs = excluded["spatial_ref"].attrs
     excluded = xr.where(excluded == 0, excluded, 100, keep_attrs=True)
@@ -173,6 +195,11 @@ def load_worldcover(bbox, path_cache, raster_to_match):
     basename = "worldcover.tif"
     fpath = path_cache / basename
 
+    # Custom sub-regions reproject their parent's raster
+    parent_fpath = find_parent_file(path_cache, basename)
+    if parent_fpath is not None:
+        fpath = parent_fpath
+
     if not fpath.exists():
         src_addrs = "ESA/WorldCover/v100"
 
@@ -198,7 +225,7 @@ def load_worldcover(bbox, path_cache, raster_to_match):
                 print(f"An error occurred while downloading {basename} 2.")
                 return
 
-            with open(fpath, "wb") as fd:
+            with atomic_path(fpath) as tmp_path, open(tmp_path, "wb") as fd:
                 fd.write(r.content)
             print(f"Data downloaded to {fpath}")
 
@@ -216,7 +243,8 @@ def load_worldcover(bbox, path_cache, raster_to_match):
     print("Reproyectando y guardando el archivo de World Cover...")
     worldcover = worldcover.rio.reproject_match(raster_to_match, Resampling.mode)
     worldcover.name = "worldcover"
-    np.save(path_cache / "worldcover.npy", worldcover)
+    with atomic_path(path_cache / "worldcover.npy") as tmp_path:
+        np.save(tmp_path, worldcover)
     print("Archivo de World Cover reproyectado y guardado.")
 
 
@@ -230,6 +258,11 @@ def load_slope(bbox, path_cache, raster_to_match):
 
     fpath = path_cache / "slope.tif"
 
+    # Custom sub-regions reproject their parent's raster
+    parent_fpath = find_parent_file(path_cache, fpath.name)
+    if parent_fpath is not None:
+        fpath = parent_fpath
+
     if not fpath.exists():
         src_addrs = "projects/sat-io/open-datasets/Geomorpho90m/slope"
 
@@ -248,7 +281,16 @@ def load_slope(bbox, path_cache, raster_to_match):
     # Type must be int, zero values have issues, so use ceil
     # Zero slope values have been reported to unrealistically
     # attract urbanization. (TODO: reference needed)
-    slope = np.ceil((slope + 0.01) * 100 / 90).astype(np.int32)
+    if ghsl.COMPACT_DTYPES:
+        float_dtype, int_dtype = "float32", "uint8"
+    else:
+        float_dtype, int_dtype = "float64", "int32"
+    data = slope.values.astype(float_dtype)
+    data += 0.01
+    data *= 100
+    data /= 90
+    np.ceil(data, out=data)
+    slope = slope.copy(data=data.astype(int_dtype))
 
     # Validate
     min_slope = slope.min().item()
@@ -263,6 +305,11 @@ def load_slope(bbox, path_cache, raster_to_match):
 def load_protected(bbox, path_cache, raster_to_match):
     fpath = path_cache / "protected.tif"
 
+    # Custom sub-regions reproject their parent's raster
+    parent_fpath = find_parent_file(path_cache, fpath.name)
+    if parent_fpath is not None:
+        fpath = parent_fpath
+
     if not fpath.exists():
         col = (
             ee.FeatureCollection("WCMC/WDPA/current/polygons")
@@ -315,7 +362,7 @@ def local_download(img, bbox, fpath):
             print(f"An error occurred while downloading {basename} 2.")
             return
 
-        with open(fpath, "wb") as fd:
+        with atomic_path(fpath) as tmp_path, open(tmp_path, "wb") as fd:
             fd.write(r.content)
         print(f"Data downloaded to {fpath}")
 
@@ -492,27 +539,42 @@ def load_roads_osm(bbox, path_cache, force_download=False):
     # Load the road graph
     G_path = path_cache / "road_network.graphml"
     edges_path = path_cache / "roads.gpkg"
-    if not edges_path.is_file() or force_download:
-        if not G_path.is_file():
-            print("Downloading the graph...")
-            # Download roads from OSM
-            G = ox.graph_from_polygon(bbox, network_type="drive")
-            G = ox.project_graph(G, to_crs="ESRI:54009")
-            ox.save_graphml(G, G_path)
+    with single_flight(edges_path):
+        parent_edges_path = find_parent_file(path_cache, edges_path.name)
+        if parent_edges_path is not None and not force_download:
+            # Custom sub-regions keep the parent's edges within their bbox
+            print("Filtering the parent's edges gdf...")
+            edges = gpd.read_file(parent_edges_path)
+            bbox_edges = gpd.GeoSeries([bbox], crs="EPSG:4326").to_crs(edges.crs)
+            idx = edges.sindex.query(bbox_edges.iloc[0], predicate="intersects")
+            edges = edges.iloc[np.sort(idx)]
+            with atomic_path(edges_path) as tmp_path:
+                edges.to_file(tmp_path, layer=edges_path.stem)
+        elif not edges_path.is_file() or force_download:
+            if not G_path.is_file():
+                print("Downloading the graph...")
+                # Download roads from OSM
+                G = ox.graph_from_polygon(bbox, network_type="drive")
+                G = ox.project_graph(G, to_crs="ESRI:54009")
+                with atomic_path(G_path) as tmp_path:
+                    ox.save_graphml(G, tmp_path)
+            else:
+                print("Loading the graph...")
+                G = ox.load_graphml(G_path)
+
+            # Create vector geodataframe to burn in
+            print("Creating edges gdf...")
+            edges = ox.graph_to_gdfs(G, nodes=False)
+            # Specify weight type, larger means more accessible
+            edges["weight"] = edges.apply(
+                lambda x: simplify_road_type(x.highway), axis=1
+            )
+            edges = edges[["length", "weight", "geometry"]]
+            with atomic_path(edges_path) as tmp_path:
+                edges.to_file(tmp_path, layer=edges_path.stem)
         else:
-            print("Loading the graph...")
-            G = ox.load_graphml(G_path)
-
-        # Create vector geodataframe to burn in
-        print("Creating edges gdf...")
-        edges = ox.graph_to_gdfs(G, nodes=False)
-        # Specify weight type, larger means more accessible
-        edges["weight"] = edges.apply(lambda x: simplify_road_type(x.highway), axis=1)
-        edges = edges[["length", "weight", "geometry"]]
-        edges.to_file(path_cache / "roads.gpkg")
-    else:
-        print("Loading edges gdf...")
-        edges = gpd.read_file(path_cache / "roads.gpkg")
+            print("Loading edges gdf...")
+            edges = gpd.read_file(edges_path)
 
     print("Done.")
     return edges
@@ -0,0 +1,279 @@
+""" XYZ tiles of the raster overlays of the historical growth maps.
+
+Instead of embedding a colorized image of the whole bounding box in each
+figure, the maps reference a tile URL (see ursa.ghsl.get_tile_url) served
+by the app's Flask server. Tiles are 256 x 256 PNGs in web mercator,
+rendered on demand from the full resolution GHS stacks in the city cache
+with the same colors as the images, so they stay sharp at every zoom.
+
+Tiles are palette mode PNGs colored as in ursa.utils.render. Rendered
+tiles are kept in memory in a LRU cache, and the sources they are
+rendered from, a band of a stack read from disk, in a smaller one.
+
+    /tiles/<cache>/built_agg/<z>/<x>/<y>.png?thresh=0.2
+    /tiles/<cache>/built_year/<z>/<x>/<y>.png?year=2020
+    /tiles/<cache>/pop_year/<z>/<x>/<y>.png?year=2020
+"""
+
+import threading
+
+import numpy as np
+import ursa.ghsl as ghsl
+import ursa.utils.raster as ru
+import ursa.utils.render as ur
+
+from collections import OrderedDict
+from flask import Response, abort, request
+from pathlib import Path
+from rasterio.transform import from_bounds
+from rasterio.warp import Resampling, reproject, transform_bounds
+
+PATH_CACHE = Path("./data/cache/")
+
+TILE_SIZE = 256
+
+# Half the side of the web mercator square, in meters
+MERCATOR_EXTENT = 20037508.342789244
+
+# Number of rendered tiles and of sources kept in memory by each process
+TILE_CACHE_SIZE = 2048
+SOURCE_CACHE_SIZE = 8
+
+# Browsers may keep tiles for a day, cached rasters don't change
+MAX_AGE = 24 * 3600
+
+LAYERS = ["built_agg", "built_year", "pop_year"]
+
+# Built fraction thresholds of the first epoch layer used by the figures.
+# Each threshold computes and caches a first epoch raster in the city
+# cache, so no other value is served.
+THRESHOLDS = [0.2]
+
+_tiles = OrderedDict()
+_sources = OrderedDict()
+_lock = threading.Lock()
+
+# Locks of the sources being loaded, so concurrent tiles load each once
+_source_locks = {}
+
+
+def _lru_get(cache, key):
+    with _lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+
+def _lru_put(cache, key, value, max_size):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+def tile_bounds(z, x, y):
+    """Returns the web mercator bounds (west, south, east, north) of tile
+    x, y at zoom level z."""
+
+    size = 2 * MERCATOR_EXTENT / 2**z
+    west = -MERCATOR_EXTENT + x * size
+    north = MERCATOR_EXTENT - y * size
+
+    return west, north - size, west + size, north
+
+
+def read_band(path_cache, ds, year):
+    """Reads a band of a cached GHS stack at 100 m."""
+
+    fpath = ghsl.get_cache_path(path_cache, ds, 100)
+    if not fpath.exists():
+        return None
+
+    raster = ru.open_stack(fpath)
+    raster.coords["band"] = ghsl.get_year_list(ds)
+    if year is not None:
+        raster = raster.sel(band=year)
+
+    return raster.load()
+
+
+def read_source(path_cache, layer, year=None, thresh=0.2):
+    """Reads the source a layer's tiles are rendered from, see
+    load_source."""
+
+    if layer == "built_agg":
+        raster = read_band(path_cache, "BUILT_S", None)
+        if raster is None:
+            return None
+        pixel_area = abs(np.prod(raster.rio.resolution()))
+        raster = ghsl.load_or_get_first_epoch(
+            raster, thresh * pixel_area, "BUILT_S", path_cache
+        )
+        params = {}
+    elif layer == "built_year":
+        raster = read_band(path_cache, "BUILT_S", year)
+        if raster is None:
+            return None
+        pixel_area = abs(np.prod(raster.rio.resolution()))
+        raster = ghsl.to_density(raster, pixel_area)
+        params = {}
+    else:
+        raster = read_band(path_cache, "POP", year)
+        if raster is None:
+            return None
+        params = {"pop_min": ur.get_pop_min(raster.values)}
+
+    return {
+        "array": raster.values,
+        "transform": raster.rio.transform(),
+        "crs": raster.rio.crs,
+        "bounds": transform_bounds(raster.rio.crs, "EPSG:3857", *raster.rio.bounds()),
+        "params": params,
+    }
+
+
+def load_source(path_cache, layer, year=None, thresh=0.2):
+    """Returns the source a layer's tiles are rendered from, as a
+    dictionary with the array to colorize, its transform and CRS, its web
+    mercator bounds and the parameters of the colorization. Returns None
+    if the city's cache lacks the stack.
+
+    Sources are single band arrays in the stacks' grid, holding the first
+    epoch codes for built_agg, built fractions for built_year and people
+    per pixel for pop_year, so tiles only reproject and colorize them.
+
+    A map's first load requests many tiles of the same source at once,
+    the first one reads it while the rest wait and take it from memory.
+    """
+
+    key = (str(path_cache), layer, year, thresh)
+    source = _lru_get(_sources, key)
+    if source is not None:
+        return source
+
+    with _lock:
+        key_lock = _source_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        try:
+            source = _lru_get(_sources, key)
+            if source is None:
+                source = read_source(path_cache, layer, year, thresh)
+                if source is not None:
+                    _lru_put(_sources, key, source, SOURCE_CACHE_SIZE)
+        finally:
+            with _lock:
+                if _source_locks.get(key) is key_lock:
+                    del _source_locks[key]
+
+    return source
+
+
+def colorize(layer, array, params):
+    """Returns the color indices and lookup table of a tile of a layer,
+    colored as the maps' images are."""
+
+    if layer == "built_agg":
+        return ur.epochs_indices(array), ur.EPOCHS_LUT
+    elif layer == "built_year":
+        return ur.fraction_indices(array), ur.FRACTION_LUT
+    else:
+        return ur.pop_indices(array, params["pop_min"]), ur.POP_LUT
+
+
+def render_tile(source, layer, z, x, y):
+    """Renders a tile of a source as PNG bytes, or returns None if the
+    tile is outside the source or empty."""
+
+    bounds = tile_bounds(z, x, y)
+    west, south, east, north = source["bounds"]
+    if bounds[0] >= east or bounds[2] <= west:
+        return None
+    if bounds[1] >= north or bounds[3] <= south:
+        return None
+
+    # Nearest neighbour, as the images, keeps codes and class values
+    tile = np.zeros((TILE_SIZE, TILE_SIZE), dtype=source["array"].dtype)
+    reproject(
+        source["array"],
+        tile,
+        src_transform=source["transform"],
+        src_crs=source["crs"],
+        src_nodata=0,
+        dst_transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE),
+        dst_crs="EPSG:3857",
+        dst_nodata=0,
+        resampling=Resampling.nearest,
+    )
+    indices, lut = colorize(layer, tile, source["params"])
+    if not indices.any():
+        return None
+
+    return ur.to_png(indices, lut)
+
+
+def get_tile(path_cache, layer, z, x, y, year=None, thresh=0.2):
+    """Returns the PNG bytes of a tile, from the LRU cache if it was
+    already rendered. Returns None for empty tiles."""
+
+    # Empty tiles are cached too, as None
+    key = (str(path_cache), layer, year, thresh, z, x, y)
+    with _lock:
+        if key in _tiles:
+            _tiles.move_to_end(key)
+            return _tiles[key]
+
+    source = load_source(path_cache, layer, year, thresh)
+    if source is None:
+        return None
+
+    png = render_tile(source, layer, z, x, y)
+    _lru_put(_tiles, key, png, TILE_CACHE_SIZE)
+
+    return png
+
+
+def serve_tile(cache, layer, z, x, y):
+    if layer not in LAYERS or not 0 <= x < 2**z or not 0 <= y < 2**z:
+        abort(404)
+
+    # Only city caches can be served
+    path_cache = PATH_CACHE / cache
+    if path_cache.resolve().parent != PATH_CACHE.resolve():
+        abort(404)
+    if not path_cache.is_dir():
+        abort(404)
+
+    year = request.args.get("year", type=int)
+    thresh = request.args.get("thresh", default=0.2, type=float)
+    # Parameters a layer doesn't use are dropped, so they don't miss caches
+    if layer == "built_agg":
+        if thresh not in THRESHOLDS:
+            abort(404)
+        year = None
+    else:
+        if year not in ghsl.get_year_list("BUILT_S"):
+            abort(404)
+        thresh = None
+
+    png = get_tile(path_cache, layer, z, x, y, year, thresh)
+    if png is None:
+        response = Response(status=204)
+    else:
+        response = Response(png, mimetype="image/png")
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+
+    return response
+
+
+def register_tiles(server):
+    """Adds the tile endpoint to the app's Flask server."""
+
+    server.add_url_rule(
+        "/tiles/<cache>/<layer>/<int:z>/<int:x>/<int:y>.png",
+        "tiles",
+        serve_tile,
+    )
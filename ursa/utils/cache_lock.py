@@ -0,0 +1,127 @@
+""" Coordination of cached artifacts shared by concurrent workers.
+
+Cached artifacts (GHS stacks, DoU rasters, SLEUTH inputs, CSVs) are
+produced the first time a city is visited. When several users or Dash
+workers open the same uncached city at once, single_flight makes the
+first one produce each artifact while the rest wait for it and then load
+it from disk, and atomic_path makes sure no reader ever sees a half
+written file.
+"""
+
+import os
+import threading
+import uuid
+
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# In process locks, a lock per artifact, and the artifacts held by each thread
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+
+    # msvcrt gives up after 10 seconds, keep waiting
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def _artifact_lock(fpath):
+    key = os.path.abspath(fpath)
+
+    held = getattr(_held, "paths", None)
+    if held is None:
+        held = _held.paths = set()
+    if key in held:
+        # Already held by this thread, locks are reentrant
+        yield
+        return
+
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(key, threading.Lock())
+
+    with thread_lock:
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        lock_path = fpath.with_name(f".{fpath.name}.lock")
+        with open(lock_path, "a+") as f:
+            _lock_file(f)
+            held.add(key)
+            try:
+                yield
+            finally:
+                held.discard(key)
+                _unlock_file(f)
+
+
+@contextmanager
+def single_flight(*fpaths):
+    """Serializes the production of one or more cached artifacts.
+
+    Holds a lock per artifact, across threads (a lock per path) and
+    processes (a lock file next to the artifact), for the duration of the
+    block. Callers check for the artifact inside the block, so the first
+    one produces it and later ones, once the lock is released, load it.
+    Locks are acquired in a fixed order to avoid deadlocks, and are
+    reentrant within a thread.
+
+    Parameters
+    ----------
+    fpaths : Path
+        Paths of the artifacts.
+
+    """
+
+    fpaths = sorted({Path(fpath) for fpath in fpaths}, key=os.path.abspath)
+
+    with ExitStack() as stack:
+        for fpath in fpaths:
+            stack.enter_context(_artifact_lock(fpath))
+        yield
+
+
+@contextmanager
+def atomic_path(fpath):
+    """Yields a temporary path to write fpath to, which is renamed to
+    fpath once the block completes.
+
+    The temporary file lives in the same directory and keeps the suffix,
+    so writers that choose a format or append an extension from it keep
+    working. Its stem starts with an underscore rather than a dot, as
+    GDAL names GeoPackage layers after the stem and rejects a leading
+    dot. On failure it is removed and fpath is left untouched.
+    """
+
+    fpath = Path(fpath)
+    tmp_path = fpath.with_name(
+        f"_{fpath.stem}.{os.getpid()}.{uuid.uuid4().hex}{fpath.suffix}"
+    )
+    try:
+        yield tmp_path
+        os.replace(tmp_path, fpath)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
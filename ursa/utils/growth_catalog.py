@@ -0,0 +1,172 @@
+""" Compute the urban growth table of every city in the catalog.
+
+The tables, as returned by ursa.ghsl.get_urb_growth_df, are computed in a
+process pool, reusing the GHS stacks and growth tables already in the
+city caches, and written to a single Parquet dataset partitioned by
+country and city, with a row per year:
+
+    data/cache/growth_catalog/country=<country>/city=<city>/part-0.parquet
+
+The dataset can be read at once with pandas.read_parquet. Cities already
+in the dataset are skipped unless a refresh is forced, so interrupted
+runs resume where they stopped.
+"""
+
+import argparse
+import time
+
+import pandas as pd
+import ursa.ghsl as ghsl
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import quote
+from ursa.utils.cache_lock import atomic_path
+from ursa.utils.warm_cache import (
+    PATH_CACHE,
+    PATH_FUA,
+    get_city_geometries,
+    load_catalog,
+)
+
+DATASET_PATH = PATH_CACHE / "growth_catalog"
+
+
+def get_partition_path(country, city, dataset_path=DATASET_PATH):
+    """Returns the path of the Parquet file of a city in the dataset.
+
+    Partition values are URI encoded, as pyarrow expects, so names with
+    spaces, accents or slashes are read back unchanged.
+    """
+
+    return (
+        Path(dataset_path)
+        / f"country={quote(country, safe='')}"
+        / f"city={quote(city, safe='')}"
+        / "part-0.parquet"
+    )
+
+
+def city_growth(country, city, path_fua=PATH_FUA, path_cache=PATH_CACHE):
+    """Returns the urban growth table of a city, computing it from its cache
+    as the historical growth page does."""
+
+    geoms = get_city_geometries(city, country, path_fua)
+    city_cache = Path(path_cache) / str(geoms["hash"])
+    city_cache.mkdir(exist_ok=True, parents=True)
+
+    smod, built, pop = ghsl.load_plot_datasets(
+        geoms["bbox_mollweide"], city_cache, clip=True
+    )
+
+    return ghsl.load_or_get_urb_growth_df(
+        smod=smod,
+        built=built,
+        pop=pop,
+        centroid_mollweide=geoms["uc_mollweide"].centroid,
+        path_cache=city_cache,
+    )
+
+
+def write_city_growth(country, city, dataset_path=DATASET_PATH):
+    """Computes the growth table of a city and writes it to its partition
+    of the dataset. Returns the number of rows written."""
+
+    df = city_growth(country, city)
+    df["year"] = df["year"].astype("int64")
+
+    fpath = get_partition_path(country, city, dataset_path)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(fpath) as tmp_path:
+        df.to_parquet(tmp_path, index=False)
+
+    return len(df)
+
+
+def build_growth_catalog(cities, workers=4, dataset_path=DATASET_PATH, force=False):
+    """Writes the growth table of every city to the dataset, in a process
+    pool.
+
+    Parameters
+    ----------
+    cities : list of tuple
+        List of (country, city) pairs.
+    workers : int
+        Number of worker processes.
+    dataset_path : Path
+        Root directory of the Parquet dataset.
+    force : bool
+        Recompute cities already in the dataset.
+
+    """
+
+    if force:
+        pending = list(cities)
+    else:
+        pending = [
+            (country, city)
+            for country, city in cities
+            if not get_partition_path(country, city, dataset_path).exists()
+        ]
+    print(f"{len(cities) - len(pending)} cities already done, {len(pending)} pending.")
+
+    failed = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for country, city in pending:
+            future = executor.submit(write_city_growth, country, city, dataset_path)
+            futures[future] = (country, city)
+        for i, future in enumerate(as_completed(futures), start=1):
+            country, city = futures[future]
+            try:
+                n_rows = future.result()
+                print(f"[{i}/{len(pending)}] {country}/{city}: {n_rows} years")
+            except Exception as e:
+                failed.append((country, city))
+                print(f"[{i}/{len(pending)}] {country}/{city}: failed ({e})")
+
+    print(f"Done in {time.perf_counter() - start:.1f} s, {len(failed)} failed.")
+
+
+def load_growth_catalog(dataset_path=DATASET_PATH):
+    """Reads the whole dataset into a DataFrame with country, city and year
+    columns."""
+
+    df = pd.read_parquet(dataset_path)
+    df["country"] = df["country"].astype(str)
+    df["city"] = df["city"].astype(str)
+    columns = [c for c in df.columns if c not in ("country", "city")]
+    df = df[["country", "city"] + columns]
+
+    return df.sort_values(["country", "city", "year"]).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--country", nargs="+", help="Only process cities in these countries."
+    )
+    parser.add_argument("--city", nargs="+", help="Only process these cities.")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of worker processes."
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=DATASET_PATH,
+        help="Root directory of the Parquet dataset.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Recompute cities already in the dataset.",
+    )
+    args = parser.parse_args()
+
+    cities = load_catalog(args.country, args.city)
+    build_growth_catalog(cities, args.workers, args.output, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+""" Mirror the Latin America and the Caribbean extent of every GHSL product
+into a local directory, to be used as a local raster source.
+
+The mirror keeps the same relative paths as the S3 bucket, so it can be
+used directly as a local source (URSA_RASTER_SOURCE=local and
+URSA_RASTER_ROOT=<root>) or uploaded as is to an S3 compatible server,
+like MinIO (URSA_RASTER_SOURCE=endpoint).
+"""
+
+import argparse
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+import ursa.ghsl as ghsl
+import ursa.utils.raster as ru
+
+from pathlib import Path
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from shapely.geometry import box
+from ursa.utils.cache_lock import atomic_path
+
+CITIES_PATH = Path("./data/output/cities/cities_fua.gpkg")
+
+# Size in pixels of the windows copied at a time
+CHUNK_SIZE = 4096
+
+# Decimation factors of the overviews built for every mirrored COG
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+
+
+def get_region_bbox(cities_path=CITIES_PATH, buff=50):
+    """Returns the bounding box, in Mollweide, of every city in the catalog
+    buffered by buff kilometers."""
+
+    cities = gpd.read_file(cities_path).to_crs("ESRI:54009")
+    xmin, ymin, xmax, ymax = cities.total_bounds
+    buff = buff * 1000
+
+    return box(xmin - buff, ymin - buff, xmax + buff, ymax + buff)
+
+
+def mirror_cog(rel_path, bbox, root, source, resampling=Resampling.average):
+    """Copies the window defined by bbox of a COG in source into a tiled
+    and compressed GeoTIFF under root, with the same relative path.
+
+    The window is copied in chunks, so memory use is bounded, and written
+    through atomic_path, so an interrupted copy leaves no partial file.
+    Existing files are skipped.
+    """
+
+    fpath = Path(root) / rel_path
+    if fpath.exists():
+        print(f"Skipping {fpath.name}, already mirrored.")
+        return
+
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    url = ru.source_url(rel_path, source)
+    env = {**ru.GDAL_HTTP_OPTIONS, **ru.source_env(source)}
+    with atomic_path(fpath) as tmp_path, rio.Env(**env), rio.open(url) as src:
+        window = rio.windows.from_bounds(*bbox.bounds, src.transform)
+        window = window.round_lengths().round_offsets()
+        window = window.intersection(Window(0, 0, src.width, src.height))
+        height, width = int(window.height), int(window.width)
+
+        profile = src.profile.copy()
+        profile.update(
+            driver="GTiff",
+            height=height,
+            width=width,
+            transform=src.window_transform(window),
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            compress="deflate",
+            predictor=2 if np.issubdtype(src.dtypes[0], np.integer) else 3,
+            BIGTIFF="IF_SAFER",
+        )
+
+        with rio.open(tmp_path, "w", **profile) as dst:
+            for i in range(0, height, CHUNK_SIZE):
+                for j in range(0, width, CHUNK_SIZE):
+                    chunk = Window(
+                        j,
+                        i,
+                        min(CHUNK_SIZE, width - j),
+                        min(CHUNK_SIZE, height - i),
+                    )
+                    src_chunk = Window(
+                        window.col_off + j,
+                        window.row_off + i,
+                        chunk.width,
+                        chunk.height,
+                    )
+                    dst.write(src.read(window=src_chunk), window=chunk)
+            dst.build_overviews(OVERVIEW_FACTORS, resampling)
+            dst.update_tags(ns="rio_overview", resampling=resampling.name)
+
+    print(f"Mirrored {fpath.name} ({height} x {width}).")
+
+
+def mirror_ghsl(root, bbox, products=None, source=None):
+    """Mirrors the window defined by bbox of every year of every GHSL
+    product into root.
+
+    Parameters
+    ----------
+    root : Path
+        Root directory of the mirror.
+    bbox : Polygon
+        Shapely Polygon defining the bounding box, in Mollweide.
+    products : list of tuple
+        List of (ds, resolution) pairs to mirror,
+        defaults to ghsl.GHS_PRODUCTS.
+    source : dict
+        Source to copy from, defaults to the public S3 bucket.
+
+    """
+
+    if products is None:
+        products = ghsl.GHS_PRODUCTS
+    if source is None:
+        source = ru.make_source("s3")
+
+    for ds, resolution in products:
+        # SMOD is categorical, its overviews can't be averaged
+        if ds == "SMOD":
+            resampling = Resampling.nearest
+        else:
+            resampling = Resampling.average
+        for rel_path in ghsl.get_s3_paths(ds, resolution):
+            mirror_cog(rel_path, bbox, root, source, resampling)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, help="Root directory of the mirror.")
+    parser.add_argument(
+        "--cities",
+        type=Path,
+        default=CITIES_PATH,
+        help="City catalog defining the extent to mirror.",
+    )
+    parser.add_argument(
+        "--buffer",
+        type=float,
+        default=50,
+        help="Buffer around the catalog's extent, in kilometers.",
+    )
+    args = parser.parse_args()
+
+    bbox = get_region_bbox(args.cities, args.buffer)
+    mirror_ghsl(args.root, bbox)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,46 @@
 from osgeo import gdal
+import hashlib
+import json
+import os
+import time
 import numpy as np
 import geopandas as gpd
 import rasterio as rio
+import shapely
 from shapely.geometry import box, Polygon
 import ee
 from pathlib import Path
 import rioxarray as rxr
 import xarray as xr
 
+from affine import Affine
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from ursa.utils.cache_lock import atomic_path
+
+# GDAL configuration for windowed reads of COGs over HTTP.
+# Skip directory listings when opening a file, merge neighbouring byte
+# ranges into a single request and keep connections alive between reads.
+GDAL_HTTP_OPTIONS = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif",
+    GDAL_HTTP_MULTIRANGE="YES",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    GDAL_HTTP_MULTIPLEX="YES",
+    GDAL_HTTP_VERSION="2",
+    GDAL_HTTP_TCP_KEEPALIVE="YES",
+    VSI_CACHE="TRUE",
+)
+
+# Maximum number of simultaneous window reads
+MAX_WORKERS = 16
+
+# Public bucket with the global COGs
+DEFAULT_BUCKET = "tec-expansion-urbana-p"
+
 
 def row2cell(row, res_xy):
     # Extract resolution for each dimension
@@ -24,6 +57,50 @@ def row2cell(row, res_xy):
     return poly
 
 
+def cells_from_xy(x, y, res_xy):
+    """Vectorized version of row2cell, returns an array with the polygon of
+    every pixel centered on the x and y coordinate arrays."""
+
+    res_x, res_y = res_xy
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    return shapely.box(x - res_x / 2, y + res_y / 2, x + res_x / 2, y - res_y / 2)
+
+
+def polygons_from_shapes(shapes):
+    """Builds the polygons yielded by rio.features.shapes in bulk.
+
+    Returns
+    -------
+    geoms : np.array
+        Array of shapely Polygons.
+    values : np.array
+        Array with the raster value of each polygon.
+
+    """
+
+    values = []
+    n_rings = []
+    ring_sizes = []
+    coords = []
+    for geom, value in shapes:
+        values.append(value)
+        n_rings.append(len(geom["coordinates"]))
+        for ring in geom["coordinates"]:
+            ring_sizes.append(len(ring))
+            coords.extend(ring)
+    coords = np.array(coords, dtype="float64").reshape(-1, 2)
+
+    # The first ring of each polygon is its exterior, the rest holes
+    rings = shapely.linearrings(
+        coords, indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes)
+    )
+    geoms = shapely.polygons(rings, indices=np.repeat(np.arange(len(values)), n_rings))
+
+    return geoms, np.array(values)
+
+
 def km_2_lat(d):
     # radius of the earth
     R = 6371
@@ -128,8 +205,284 @@ def get_bboxes(city, country, data_path, buff=10, square=False):
     )
 
 
+def make_source(kind="s3", bucket=DEFAULT_BUCKET, root=None, endpoint=None):
+    """Defines a source of global COGs.
+
+    Relative COG paths, like the ones in S3, are resolved against the
+    source. Sources are plain dictionaries, so they can be pickled and
+    stored.
+
+    Parameters
+    ----------
+    kind : str
+        One of 's3' for a public bucket in Amazon S3 read over HTTP,
+        'local' for a local directory with the same layout as the bucket,
+        or 'endpoint' for an S3 compatible server, like MinIO.
+    bucket : str
+        Name of the bucket, for 's3' and 'endpoint' sources.
+    root : str or Path
+        Root directory, for 'local' sources.
+    endpoint : str
+        URL of the server, e.g. http://localhost:9000, for 'endpoint'
+        sources. Credentials are taken from the usual AWS environment
+        variables, if absent requests are unsigned.
+
+    Returns
+    -------
+    source : dict
+        Source definition.
+
+    """
+
+    assert kind in ["s3", "local", "endpoint"], "Unknown source kind."
+
+    if kind == "local":
+        assert root is not None, "A root directory is needed for local sources."
+        return {"kind": kind, "root": str(root)}
+    if kind == "endpoint":
+        assert endpoint is not None, "An endpoint is needed for endpoint sources."
+        return {"kind": kind, "bucket": bucket, "endpoint": endpoint}
+    return {"kind": kind, "bucket": bucket}
+
+
+def source_from_env():
+    """Defines a source of global COGs from environment variables.
+
+    URSA_RASTER_SOURCE selects the kind of source (s3, local or endpoint),
+    URSA_RASTER_ROOT the root directory of local sources, URSA_S3_ENDPOINT
+    the URL of endpoint sources and URSA_S3_BUCKET the bucket name.
+    Returns None if URSA_RASTER_SOURCE is not set.
+    """
+
+    kind = os.environ.get("URSA_RASTER_SOURCE")
+    if kind is None:
+        return None
+
+    return make_source(
+        kind,
+        bucket=os.environ.get("URSA_S3_BUCKET", DEFAULT_BUCKET),
+        root=os.environ.get("URSA_RASTER_ROOT"),
+        endpoint=os.environ.get("URSA_S3_ENDPOINT"),
+    )
+
+
+def source_url(rel_path, source):
+    """Returns the URL or path GDAL uses to open rel_path from source."""
+
+    if source["kind"] == "local":
+        return str(Path(source["root"]) / rel_path)
+    if source["kind"] == "endpoint":
+        return f"/vsis3/{source['bucket']}/{rel_path}"
+    return f"http://{source['bucket']}.s3.amazonaws.com/{rel_path}"
+
+
+def source_env(source):
+    """Returns the GDAL configuration options needed to read from source."""
+
+    if source["kind"] != "endpoint":
+        return {}
+
+    endpoint = source["endpoint"]
+    env = {
+        "AWS_S3_ENDPOINT": endpoint.split("://")[-1].rstrip("/"),
+        "AWS_HTTPS": "NO" if endpoint.startswith("http://") else "YES",
+        "AWS_VIRTUAL_HOSTING": "FALSE",
+    }
+    if "AWS_ACCESS_KEY_ID" not in os.environ:
+        env["AWS_NO_SIGN_REQUEST"] = "YES"
+
+    return env
+
+
+def get_decimation(bbox, resolution, max_size):
+    """Returns the integer decimation factor needed for a raster with
+    bounds defined by bbox and the given resolution to fit in max_size
+    pixels along its longest side."""
+
+    xmin, ymin, xmax, ymax = bbox.bounds
+    n_pixels = max(xmax - xmin, ymax - ymin) / resolution
+
+    return max(1, int(np.ceil(n_pixels / max_size)))
+
+
+def np_from_bbox(
+    url, bbox, nodata_to_zero=False, block_cache_dir=None, env=None, decimation=1
+):
+    """Reads a windowed raster with bounds defined by bbox from a COG
+    and stores it in memory in a numpy array.
+
+    Parameters
+    ----------
+    url : str
+        URL or path of the COG, as returned by source_url.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    nodata_to_zero : bool
+        If True, sets the output raster's nodata attribute to 0.
+    block_cache_dir : Path
+        If given, reads are served from a local cache of the COG's
+        internal tiles, see np_from_bbox_blocks.
+    env : dict
+        Additional GDAL configuration options, as returned by source_env.
+    decimation : int
+        If greater than 1, reads a raster with pixels decimation times
+        larger, see np_from_bbox_decimated. The tile cache is not used.
+
+    Returns
+    -------
+    subset : np.array
+        Numpy array with raster data.
+    profile : dict
+        Dictionary with geographical properties of the raster.
+
+    """
+
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+
+    if decimation > 1:
+        return np_from_bbox_decimated(url, bbox, decimation, nodata_to_zero, env)
+
+    if block_cache_dir is not None:
+        return np_from_bbox_blocks(url, bbox, block_cache_dir, nodata_to_zero, env)
+
+    with _open(url, env) as src:
+        profile = src.profile.copy()
+        transform = profile["transform"]
+        window = rio.windows.from_bounds(*bbox.bounds, transform)
+        window = window.round_lengths().round_offsets()
+        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
+        new_transform = src.window_transform(window)
+        profile.update(
+            {"height": window.height, "width": window.width, "transform": new_transform}
+        )
+        subset = src.read(window=window)
+    if nodata_to_zero:
+        subset[subset == profile["nodata"]] = 0
+
+    return subset, profile
+
+
+def np_from_bbox_decimated(url, bbox, decimation, nodata_to_zero=False, env=None):
+    """Reads a windowed raster with bounds defined by bbox from a COG,
+    at a resolution decimation times coarser than the COG's.
+
+    The window is read with average resampling into a smaller array, which
+    lets GDAL serve it from the COG's closest overview instead of fetching
+    every full resolution tile. Values are scaled back to totals per
+    output pixel, so counts (population, built surface) are preserved and
+    densities can be derived from the new pixel size. Meant for map
+    previews, statistics should use full resolution reads.
+
+    Parameters
+    ----------
+    url : str
+        URL or path of the COG.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    decimation : int
+        Size of the output pixels, in COG pixels.
+    nodata_to_zero : bool
+        If True, sets the output raster's nodata attribute to 0.
+    env : dict
+        Additional GDAL configuration options, as returned by source_env.
+
+    Returns
+    -------
+    subset : np.array
+        Numpy array with float32 raster data.
+    profile : dict
+        Dictionary with geographical properties of the raster.
+
+    """
+
+    with _open(url, env) as src:
+        profile = src.profile.copy()
+        window = rio.windows.from_bounds(*bbox.bounds, profile["transform"])
+        window = window.round_lengths().round_offsets()
+        height = int(np.ceil(window.height / decimation))
+        width = int(np.ceil(window.width / decimation))
+        subset = src.read(
+            window=window,
+            out_shape=(profile["count"], height, width),
+            resampling=Resampling.average,
+        )
+        scale_x, scale_y = window.width / width, window.height / height
+        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
+        new_transform = src.window_transform(window) * Affine.scale(scale_x, scale_y)
+
+    if nodata_to_zero:
+        subset[subset == profile["nodata"]] = 0
+        nodata = 0
+    else:
+        nodata = profile["nodata"]
+
+    # Averages back to totals per output pixel
+    subset = subset.astype("float32")
+    valid = subset != nodata if nodata is not None else np.ones_like(subset, bool)
+    subset[valid] *= scale_x * scale_y
+
+    profile.update(
+        {
+            "height": height,
+            "width": width,
+            "transform": new_transform,
+            "dtype": "float32",
+            "nodata": nodata,
+        }
+    )
+
+    return subset, profile
+
+
+def coarsen_sum(raster, factor):
+    """Aggregates a raster into pixels factor times larger, adding up the
+    values of the pixels in each block.
+
+    The raster is padded with zeros to a multiple of factor, so its
+    extent is kept. Totals per pixel, like population counts, are
+    preserved. The factor is stored in the "decimation" attribute.
+
+    Parameters
+    ----------
+    raster : rioxarray.DataArray
+        Raster with dimensions (band, y, x) and nodata 0.
+    factor : int
+        Size of the output pixels, in input pixels.
+
+    Returns
+    -------
+    coarse : rioxarray.DataArray
+        In memory float32 raster.
+
+    """
+
+    count, height, width = raster.shape
+    pad_h, pad_w = -height % factor, -width % factor
+    array = np.pad(
+        raster.values.astype("float32"), ((0, 0), (0, pad_h), (0, pad_w))
+    )
+    array = array.reshape(
+        count, (height + pad_h) // factor, factor, (width + pad_w) // factor, factor
+    ).sum(axis=(2, 4))
+
+    profile = {
+        "crs": raster.rio.crs,
+        "transform": raster.rio.transform() * Affine.scale(factor),
+        "nodata": 0,
+    }
+
+    coarse = np_to_xr(array, profile, band=list(raster.band.values))
+    coarse.attrs["decimation"] = factor
+
+    return coarse
+
+
 def np_from_bbox_s3(
-    s3_path, bbox, bucket="tec-expansion-urbana-p", nodata_to_zero=False
+    s3_path,
+    bbox,
+    bucket=DEFAULT_BUCKET,
+    nodata_to_zero=False,
+    block_cache_dir=None,
 ):
     """Downloads a windowed raster with bounds defined by bbox from an
     COG stored in an Amaxon S3 bucket and stores it in memory in a numpy array.
@@ -149,6 +502,9 @@ def np_from_bbox_s3(
         Name of the S3 bucket with the COG.
     nodata_to_zero : bool
         If True, sets the output raster's nodata attribute to 0.
+    block_cache_dir : Path
+        If given, reads are served from a local cache of the COG's
+        internal tiles, see np_from_bbox_blocks.
 
     Returns
     -------
@@ -159,29 +515,427 @@ def np_from_bbox_s3(
 
     """
 
-    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    url = source_url(s3_path, make_source("s3", bucket))
 
-    url = f"http://{bucket}.s3.amazonaws.com/{s3_path}"
+    return np_from_bbox(url, bbox, nodata_to_zero, block_cache_dir)
 
-    with rio.open(url) as src:
-        profile = src.profile.copy()
-        transform = profile["transform"]
-        window = rio.windows.from_bounds(*bbox.bounds, transform)
-        window = window.round_lengths().round_offsets()
-        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
-        new_transform = src.window_transform(window)
-        profile.update(
-            {"height": window.height, "width": window.width, "transform": new_transform}
+
+@contextmanager
+def _open(url, env=None):
+    """Opens a raster for reading under the GDAL HTTP configuration,
+    plus any options in env."""
+
+    if env is None:
+        env = {}
+
+    with rio.Env(**{**GDAL_HTTP_OPTIONS, **env}), rio.open(url) as src:
+        yield src
+
+
+def _load_cog_profile(url, cache_dir, env=None):
+    """Loads the profile and internal tile shape of a COG, from cache_dir
+    if available, otherwise from the COG's header."""
+
+    fpath = cache_dir / "profile.json"
+    if fpath.exists():
+        with open(fpath, "r") as f:
+            profile = json.load(f)
+    else:
+        with _open(url, env) as src:
+            profile = dict(src.profile)
+            profile["block_shape"] = list(src.block_shapes[0])
+        profile["crs"] = profile["crs"].to_wkt()
+        profile["transform"] = list(profile["transform"])[:6]
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_path(fpath) as tmp_path, open(tmp_path, "w") as f:
+            json.dump(profile, f, default=str)
+
+    profile["crs"] = CRS.from_wkt(profile["crs"])
+    profile["transform"] = Affine(*profile["transform"])
+    block_shape = tuple(profile.pop("block_shape"))
+
+    return profile, block_shape
+
+
+def _cog_cache_name(url, env=None):
+    """Returns the name of the tile cache directory of a COG, its name
+    followed by a hash of where it is read from.
+
+    Mirrors may serve a COG under the same name as the global one but
+    cropped, with another grid and tiling, so tiles are only shared
+    between reads of the same URL from the same endpoint.
+    """
+
+    if env is None:
+        env = {}
+
+    source_id = f"{url}|{env.get('AWS_S3_ENDPOINT', '')}"
+    digest = hashlib.sha1(source_id.encode()).hexdigest()[:12]
+
+    return f"{Path(url).stem}-{digest}"
+
+
+def np_from_bbox_blocks(url, bbox, cache_dir, nodata_to_zero=False, env=None):
+    """Reads a windowed raster with bounds defined by bbox from a COG,
+    through a local cache of the COG's internal tiles.
+
+    Each internal tile of the COG is downloaded at most once and stored in
+    cache_dir/{COG name}-{source hash}/{row}_{col}.npy, so the cache is
+    keyed by data set, resolution, year (all encoded in the COG name),
+    source and tile index.
+    Windows for overlapping bounding boxes are assembled from the cached
+    tiles and only the missing ones are fetched.
+
+    Parameters
+    ----------
+    url : str
+        URL or path of the COG.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    cache_dir : Path
+        Root directory of the tile cache, shared by all cities.
+    nodata_to_zero : bool
+        If True, sets the output raster's nodata attribute to 0.
+    env : dict
+        Additional GDAL configuration options, as returned by source_env.
+
+    Returns
+    -------
+    subset : np.array
+        Numpy array with raster data.
+    profile : dict
+        Dictionary with geographical properties of the raster.
+
+    """
+
+    cog_dir = Path(cache_dir) / _cog_cache_name(url, env)
+    profile, (block_h, block_w) = _load_cog_profile(url, cog_dir, env)
+
+    window = rio.windows.from_bounds(*bbox.bounds, profile["transform"])
+    window = window.round_lengths().round_offsets()
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+
+    # Internal tiles intersecting the window
+    row_start = max(row_off, 0) // block_h
+    row_stop = (min(row_off + height, profile["height"]) - 1) // block_h + 1
+    col_start = max(col_off, 0) // block_w
+    col_stop = (min(col_off + width, profile["width"]) - 1) // block_w + 1
+    tiles = [
+        (r, c) for r in range(row_start, row_stop) for c in range(col_start, col_stop)
+    ]
+
+    def tile_window(r_start, c_start, r_stop, c_stop):
+        row, col = r_start * block_h, c_start * block_w
+        return Window(
+            col,
+            row,
+            min(c_stop * block_w, profile["width"]) - col,
+            min(r_stop * block_h, profile["height"]) - row,
         )
-        subset = src.read(window=window)
+
+    blocks = {}
+    missing = []
+    for r, c in tiles:
+        fpath = cog_dir / f"{r}_{c}.npy"
+        if fpath.exists():
+            blocks[(r, c)] = np.load(fpath)
+        else:
+            missing.append((r, c))
+
+    if len(missing) > 0:
+        r_min = min(r for r, _ in missing)
+        r_max = max(r for r, _ in missing) + 1
+        c_min = min(c for _, c in missing)
+        c_max = max(c for _, c in missing) + 1
+
+        with _open(url, env) as src:
+            if len(missing) == (r_max - r_min) * (c_max - c_min):
+                # Missing tiles form a rectangle, fetch them in a single read
+                data = src.read(window=tile_window(r_min, c_min, r_max, c_max))
+                for r, c in missing:
+                    i, j = (r - r_min) * block_h, (c - c_min) * block_w
+                    blocks[(r, c)] = data[:, i : i + block_h, j : j + block_w]
+            else:
+                for r, c in missing:
+                    blocks[(r, c)] = src.read(window=tile_window(r, c, r + 1, c + 1))
+
+        for r, c in missing:
+            block = np.ascontiguousarray(blocks[(r, c)])
+            blocks[(r, c)] = block
+            with atomic_path(cog_dir / f"{r}_{c}.npy") as tmp_path:
+                np.save(tmp_path, block, allow_pickle=False)
+
+    # Assemble window from tiles, pixels outside the COG are nodata
+    fill = profile["nodata"] if profile["nodata"] is not None else 0
+    subset = np.full(
+        (profile["count"], height, width), fill, dtype=profile["dtype"]
+    )
+    for (r, c), block in blocks.items():
+        row, col = r * block_h - row_off, c * block_w - col_off
+        i0, j0 = max(row, 0), max(col, 0)
+        i1 = min(row + block.shape[1], height)
+        j1 = min(col + block.shape[2], width)
+        subset[:, i0:i1, j0:j1] = block[:, i0 - row : i1 - row, j0 - col : j1 - col]
+
+    # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
+    new_transform = rio.windows.transform(window, profile["transform"])
+    profile.update({"height": height, "width": width, "transform": new_transform})
+
     if nodata_to_zero:
         subset[subset == profile["nodata"]] = 0
 
     return subset, profile
 
 
+def np_from_bbox_many(
+    rel_paths,
+    bbox,
+    source,
+    nodata_to_zero=False,
+    max_workers=MAX_WORKERS,
+    block_cache_dir=None,
+    decimation=1,
+):
+    """Concurrently reads windowed rasters with bounds defined by bbox
+    from several COGs in a source.
+
+    Every window read is issued at once on a bounded thread pool, so the
+    total time is close to that of the slowest read instead of the sum of
+    all of them. Worker threads are reused between reads, and with them
+    GDAL's HTTP connections. The time taken by each read is reported.
+
+    Parameters
+    ----------
+    rel_paths : list of str
+        The relative paths of the COGs in the source.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    source : dict
+        Source of the COGs, as returned by make_source.
+    nodata_to_zero : bool
+        If True, sets the output rasters' nodata attribute to 0.
+    max_workers : int
+        Maximum number of simultaneous reads.
+    block_cache_dir : Path
+        If given, reads are served from a local cache of the COGs'
+        internal tiles, see np_from_bbox_blocks. Ignored for local
+        sources, which are already on disk.
+    decimation : int
+        If greater than 1, reads rasters with pixels decimation times
+        larger, see np_from_bbox_decimated.
+
+    Returns
+    -------
+    results : list of tuple
+        A (subset, profile) tuple per path, as returned by np_from_bbox,
+        in the same order as rel_paths.
+
+    """
+
+    if source["kind"] == "local":
+        block_cache_dir = None
+    env = source_env(source)
+
+    def timed_read(rel_path):
+        start = time.perf_counter()
+        result = np_from_bbox(
+            source_url(rel_path, source),
+            bbox,
+            nodata_to_zero,
+            block_cache_dir,
+            env,
+            decimation,
+        )
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_workers = max(1, min(max_workers, len(rel_paths)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        timed_results = list(executor.map(timed_read, rel_paths))
+    elapsed = time.perf_counter() - start
+
+    for rel_path, (_, read_time) in zip(rel_paths, timed_results):
+        print(f"    {rel_path.split('/')[-1]}: {read_time:.2f} s")
+    print(f"Read {len(rel_paths)} windows in {elapsed:.2f} s")
+
+    return [result for result, _ in timed_results]
+
+
+def np_from_bbox_s3_many(
+    s3_paths,
+    bbox,
+    bucket=DEFAULT_BUCKET,
+    nodata_to_zero=False,
+    max_workers=MAX_WORKERS,
+    block_cache_dir=None,
+):
+    """Concurrently downloads windowed rasters with bounds defined by bbox
+    from several COGs stored in a public Amazon S3 bucket.
+
+    See np_from_bbox_many.
+    """
+
+    return np_from_bbox_many(
+        s3_paths,
+        bbox,
+        make_source("s3", bucket),
+        nodata_to_zero,
+        max_workers,
+        block_cache_dir,
+    )
+
+
+def np_to_xr(array, profile, band=None):
+    """Builds a rioxarray DataArray from a numpy array and a rasterio profile.
+
+    The array is wrapped without copying it. Coordinates are pixel
+    centers derived from the profile's transform, and the CRS, transform
+    and nodata value are written to the DataArray.
+
+    Parameters
+    ----------
+    array : np.array
+        Array with shape (bands, height, width).
+    profile : dict
+        Dictionary with geographical properties of the raster,
+        as returned by np_from_bbox_s3.
+    band : list
+        Coordinates for the band dimension. Defaults to 1, 2, ..., bands.
+
+    Returns
+    -------
+    raster : rioxarray.DataArray
+        In memory raster.
+
+    """
+
+    count, height, width = array.shape
+    transform = profile["transform"]
+
+    if band is None:
+        band = list(range(1, count + 1))
+
+    # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
+    x = transform.c + transform.a * (np.arange(width) + 0.5)
+    y = transform.f + transform.e * (np.arange(height) + 0.5)
+
+    raster = xr.DataArray(
+        array, dims=("band", "y", "x"), coords={"band": band, "y": y, "x": x}
+    )
+    # In place, otherwise each call deep copies the whole array
+    raster.rio.write_crs(profile["crs"], inplace=True)
+    raster.rio.write_transform(transform, inplace=True)
+    if profile.get("nodata") is not None:
+        raster.rio.write_nodata(profile["nodata"], inplace=True)
+
+    return raster
+
+
+def write_stack(raster, fpath, chunk_size=512):
+    """Writes a multiband raster to disk.
+
+    The format is chosen from the file extension. GeoTIFF (.tif) files
+    are written as is. NetCDF (.nc) files are compressed and chunked
+    with a chunk per band, so single bands and windows can later be
+    read without decoding the whole stack. Files are written to a
+    temporary path and moved into place once complete.
+
+    Parameters
+    ----------
+    raster : rioxarray.DataArray
+        Raster with dimensions (band, y, x).
+    fpath : Path
+        Path of the output file.
+    chunk_size : int
+        Size in pixels of the spatial chunks of NetCDF files.
+
+    """
+
+    if fpath.suffix == ".nc":
+        name = raster.name if raster.name is not None else fpath.stem
+        _, height, width = raster.shape
+        encoding = {
+            name: {
+                "zlib": True,
+                "complevel": 4,
+                "shuffle": True,
+                "chunksizes": (1, min(chunk_size, height), min(chunk_size, width)),
+            }
+        }
+        dataset = raster.to_dataset(name=name)
+        # Explicit encodings replace the variable's own, keep the CRS link
+        dataset[name].attrs["grid_mapping"] = "spatial_ref"
+        with atomic_path(fpath) as tmp_path:
+            dataset.to_netcdf(tmp_path, encoding=encoding, engine="netcdf4")
+    else:
+        with atomic_path(fpath) as tmp_path:
+            raster.rio.to_raster(tmp_path)
+
+
+def window_stack(raster, bbox):
+    """Returns the window of a raster with bounds defined by bbox, with the
+    same rounding np_from_bbox uses, so the result matches a window read
+    of the global COG. Returns None if the window isn't fully contained in
+    the raster.
+
+    Parameters
+    ----------
+    raster : rioxarray.DataArray
+        Raster with dimensions (band, y, x).
+    bbox : Polygon
+        Shapely Polygon defining the window's bounding box.
+
+    Returns
+    -------
+    subset : rioxarray.DataArray
+        Lazily loaded window of raster.
+
+    """
+
+    _, height, width = raster.shape
+    window = rio.windows.from_bounds(*bbox.bounds, raster.rio.transform())
+    window = window.round_lengths().round_offsets()
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    row_end, col_end = row_off + int(window.height), col_off + int(window.width)
+
+    if row_off < 0 or col_off < 0 or row_end > height or col_end > width:
+        return None
+
+    return raster.isel(y=slice(row_off, row_end), x=slice(col_off, col_end))
+
+
+def open_stack(fpath):
+    """Opens a multiband raster written by write_stack.
+
+    Data is loaded lazily, only the bands and windows that are
+    selected are read from disk when values are requested.
+
+    Parameters
+    ----------
+    fpath : Path
+        Path of the raster file, either .tif or .nc.
+
+    Returns
+    -------
+    raster : rioxarray.DataArray
+        Lazily loaded raster.
+
+    """
+
+    if fpath.suffix == ".nc":
+        raster = xr.open_dataarray(
+            fpath, engine="netcdf4", decode_coords="all", mask_and_scale=False
+        )
+    else:
+        raster = rxr.open_rasterio(fpath)
+
+    return raster
+
+
 def tif_from_bbox_s3(
-    s3_path, local_path, bbox, bucket="tec-expansion-urbana-p", nodata_to_zero=False
+    s3_path, local_path, bbox, bucket=DEFAULT_BUCKET, nodata_to_zero=False
 ):
     """Downloads a windowed raster with bounds defined by bbox from an
     COG stored in an Amaxon S3 bucket and saves a local geotiff file.
@@ -314,6 +1068,77 @@ def get_area_grid(raster_xr, units):
     return area_grid
 
 
+def rasterize_labels(shapes_list, out_shape, transform, dtype="uint8"):
+    """Burns a list of (geometry, label) pairs per band into a stack of
+    label rasters.
+
+    Pixels are labeled when their center lies inside a geometry, as
+    rio.clip does, and are 0 elsewhere. Later pairs overwrite earlier ones
+    where geometries overlap.
+
+    Parameters
+    ----------
+    shapes_list : list of list of tuple
+        List with the (geometry, label) pairs of every band.
+    out_shape : tuple
+        Shape (height, width) of each band.
+    transform : Affine
+        Affine transform of the grid.
+    dtype : str
+        Data type of the labels.
+
+    Returns
+    -------
+    labels : np.array
+        Array of shape (bands, height, width) with the labels.
+
+    """
+
+    labels = np.zeros((len(shapes_list), *out_shape), dtype=dtype)
+    for i, shapes in enumerate(shapes_list):
+        if len(shapes) == 0:
+            continue
+        rio.features.rasterize(
+            shapes, out=labels[i], transform=transform, fill=0, dtype=dtype
+        )
+
+    return labels
+
+
+def zonal_sums(labels, values, n_labels):
+    """Sums values within each label of every band in a single pass.
+
+    Parameters
+    ----------
+    labels : np.array
+        Array of shape (bands, height, width) with integer labels in
+        [0, n_labels).
+    values : np.array
+        Array with the same shape as labels. NaNs are ignored.
+    n_labels : int
+        Number of labels, including the background label 0.
+
+    Returns
+    -------
+    sums : np.array
+        Array of shape (bands, n_labels) with the sum of values within each
+        label of each band.
+
+    """
+
+    n_bands = labels.shape[0]
+    offsets = np.arange(n_bands, dtype=np.intp)[:, None, None] * n_labels
+    index = (labels + offsets).ravel()
+
+    weights = np.asarray(values).ravel()
+    if np.issubdtype(weights.dtype, np.floating):
+        weights = np.where(np.isnan(weights), 0, weights)
+
+    sums = np.bincount(index, weights=weights, minlength=n_bands * n_labels)
+
+    return sums.reshape(n_bands, n_labels)
+
+
 def bbox_to_ee(bbox):
     bbox_ee = ee.Geometry.Polygon([t for t in zip(*bbox.exterior.coords.xy)])
 
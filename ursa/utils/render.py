@@ -0,0 +1,175 @@
+""" Colorization and PNG encoding of the raster overlays of the maps.
+
+Values are first quantized to uint8 indices, then colored through a
+precomputed lookup table of 256 RGBA colors, where index 0 is
+transparent. Indices are encoded as palette mode (8-bit) PNGs, with the
+lookup table as their palette, which are several times smaller than RGBA
+PNGs and need no float RGBA array to be built.
+
+Encoded images are kept in memory in a LRU cache, see load_or_render.
+"""
+
+import base64
+import io
+import threading
+
+import matplotlib as mpl
+import numpy as np
+
+from collections import OrderedDict
+from PIL import Image
+
+# Number of encoded overlay images kept in memory by each process
+RENDER_CACHE_SIZE = 64
+
+# Bounds of the population classes of the population maps, in people per
+# pixel of the data set's native resolution
+POP_BOUNDS = [5.5, 20.5, 100.5, 300.5, 500.5, 1000.5, 10000]
+
+_rendered = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_lut(colors):
+    """Returns a (256, 4) uint8 lookup table with colors at indices 1 to
+    len(colors), index 0 and unused indices are transparent.
+
+    Parameters
+    ----------
+    colors : array_like
+        RGBA colors, as floats between 0 and 1.
+
+    """
+
+    lut = np.zeros((256, 4), dtype="uint8")
+    lut[1 : len(colors) + 1] = np.uint8(np.asarray(colors) * 255)
+
+    return lut
+
+
+def epochs_lut(n_epochs=10):
+    """Lookup table of first epoch codes, as computed by
+    ursa.ghsl.first_epoch, a color of cividis per epoch."""
+
+    cmap = mpl.colormaps["cividis"].resampled(n_epochs)
+
+    return make_lut(cmap(np.arange(n_epochs)))
+
+
+def fraction_lut():
+    """Lookup table of fractions quantized by fraction_indices, 255
+    levels of cividis."""
+
+    cmap = mpl.colormaps["cividis"]
+
+    return make_lut(cmap((np.arange(255) + 0.5) / 255))
+
+
+def pop_lut():
+    """Lookup table of the population classes of pop_indices."""
+
+    n_classes = len(POP_BOUNDS)
+    cmap = mpl.colormaps["cividis"]
+
+    return make_lut(cmap(np.arange(1, n_classes + 1) / n_classes))
+
+
+EPOCHS_LUT = epochs_lut()
+FRACTION_LUT = fraction_lut()
+POP_LUT = pop_lut()
+
+
+def epochs_indices(epochs):
+    """Returns the indices of first epoch codes, which are the codes."""
+
+    return np.asarray(epochs, dtype="uint8")
+
+
+def fraction_indices(fraction):
+    """Quantizes fractions between 0 and 1 to indices 1 to 255. Zero and
+    missing values get index 0."""
+
+    fraction = np.nan_to_num(fraction)
+    indices = np.floor(fraction * 255).clip(0, 254).astype("uint8") + 1
+    indices[fraction == 0] = 0
+
+    return indices
+
+
+def pop_indices(pop, pop_min):
+    """Returns the population class of each pixel, from 1 to the number
+    of classes in POP_BOUNDS. Pixels with less than pop_min / 2 people
+    get index 0."""
+
+    pop = np.nan_to_num(pop)
+    edges = np.array([pop_min / 2.0] + POP_BOUNDS[:-1])
+
+    return np.searchsorted(edges, pop, side="right").astype("uint8")
+
+
+def get_pop_min(pop):
+    """Returns the lower bound of the first population class, averaged
+    previews may have no pixel below the first class boundary."""
+
+    return min(np.unique(pop)[1], 5.0)
+
+
+def colorize(indices, lut):
+    """Returns the RGBA array of indices colored through lut."""
+
+    return lut[indices]
+
+
+def to_png(indices, lut):
+    """Encodes indices as a palette mode PNG with lut as its palette.
+
+    Returns
+    -------
+    png : bytes
+        Encoded image.
+
+    """
+
+    # Grayscale images become palette images when given a palette
+    img = Image.fromarray(np.ascontiguousarray(indices, dtype="uint8"))
+    img.putpalette(lut[:, :3].tobytes(), rawmode="RGB")
+
+    with io.BytesIO() as f:
+        img.save(f, format="PNG", transparency=lut[:, 3].tobytes())
+        return f.getvalue()
+
+
+def to_data_uri(png):
+    """Returns the data URI of a PNG, as used for mapbox image layers."""
+
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+
+def load_or_render(key, render):
+    """Returns the result of render(), cached in memory under key.
+
+    Parameters
+    ----------
+    key : hashable
+        Key identifying the rendered image, typically the city, layer and
+        year, and the grid of the rendered raster.
+    render : callable
+        Function without arguments rendering the image. Its result must
+        not be modified by callers.
+
+    """
+
+    with _lock:
+        if key in _rendered:
+            _rendered.move_to_end(key)
+            return _rendered[key]
+
+    result = render()
+
+    with _lock:
+        _rendered[key] = result
+        _rendered.move_to_end(key)
+        while len(_rendered) > RENDER_CACHE_SIZE:
+            _rendered.popitem(last=False)
+
+    return result
@@ -0,0 +1,63 @@
+""" Custom sub-regions drawn by the user inside a city's bounding box.
+
+A sub-region gets its own cache directory, linked to the cache of the
+city it was drawn in. Inputs that don't depend on the extent are derived
+locally from the parent's cache instead of being downloaded again: GHS
+stacks are windowed, the rasters from Google Earth Engine (World Cover,
+slope and protected areas) are reused as they cover the sub-region and
+are reprojected to its grid anyway, and the road network is filtered.
+Artifacts that depend on the extent, like the degree of urbanization,
+SLEUTH inputs, growth tables, land cover and temperature statistics, are
+computed again from them.
+"""
+
+import json
+
+from pathlib import Path
+from ursa.utils.cache_lock import atomic_path
+
+PARENT_FILE = "parent.json"
+
+
+def link_parent(path_cache, parent_cache):
+    """Records parent_cache as the parent of the sub-region cached in
+    path_cache."""
+
+    path_cache = Path(path_cache)
+    path_cache.mkdir(exist_ok=True, parents=True)
+    with atomic_path(path_cache / PARENT_FILE) as tmp_path:
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump({"parent": Path(parent_cache).name}, f)
+
+
+def get_parent_cache(path_cache):
+    """Returns the cache directory of the parent city of a sub-region, or
+    None if path_cache doesn't belong to a sub-region."""
+
+    fpath = Path(path_cache) / PARENT_FILE
+    if not fpath.exists():
+        return None
+
+    with open(fpath, "r", encoding="utf8") as f:
+        parent = json.load(f)["parent"]
+
+    parent_cache = fpath.parent.parent / parent
+    if not parent_cache.is_dir():
+        return None
+
+    return parent_cache
+
+
+def find_parent_file(path_cache, name):
+    """Returns the path of the artifact name in the parent's cache, if
+    path_cache belongs to a sub-region, it doesn't have the artifact yet
+    and the parent does. Returns None otherwise."""
+
+    if (Path(path_cache) / name).exists():
+        return None
+
+    parent_cache = get_parent_cache(path_cache)
+    if parent_cache is None or not (parent_cache / name).exists():
+        return None
+
+    return parent_cache / name
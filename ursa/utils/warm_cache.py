@@ -0,0 +1,310 @@
+""" Precompute the cached per-city artifacts of every city in the catalog.
+
+Runs the same pipelines the app runs on a city's first visit, GHSL stacks,
+degree of urbanization, SLEUTH inputs, urban growth table, land cover and
+temperatures, for all or a filtered set of cities in a process pool.
+Progress is kept in a manifest, so interrupted runs resume where they
+stopped, and the time taken by every stage is reported.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import ee
+import geopandas as gpd
+import ursa.degree_of_urbanization as dou
+import ursa.dynamic_world as udw
+import ursa.ghsl as ghsl
+import ursa.heat_islands as ht
+import ursa.sleuth_prep as sp
+import ursa.utils.geometry as ug
+import ursa.utils.raster as ru
+import ursa.world_cover as wc
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from ursa.utils.cache_lock import atomic_path
+
+PATH_FUA = Path("./data/output/cities/")
+PATH_CACHE = Path("./data/cache/")
+MANIFEST_PATH = PATH_CACHE / "warm_manifest.json"
+
+# Season and year of the temperature analysis, as in the SUHI page
+SEASON = "Qall"
+YEAR = 2022
+
+
+def get_city_geometries(city, country, path_fua=PATH_FUA):
+    """Returns the geometries and cache hash of a city, as computed by the
+    home page when the city is selected."""
+
+    bbox_latlon, uc_latlon, fua_latlon = ru.get_bboxes(city, country, path_fua)
+    id_hash = ug.hash_geometry(ug.geometry_to_json(bbox_latlon))
+
+    return {
+        "hash": id_hash,
+        "bbox_latlon": bbox_latlon,
+        "uc_latlon": uc_latlon,
+        "fua_latlon": fua_latlon,
+        "bbox_mollweide": ug.reproject_geometry(bbox_latlon, "ESRI:54009").envelope,
+        "uc_mollweide": ug.reproject_geometry(uc_latlon, "ESRI:54009"),
+    }
+
+
+def warm_ghsl(geoms, path_cache):
+    ghsl.load_or_download_many(
+        geoms["bbox_mollweide"], ghsl.GHS_PRODUCTS, data_path=path_cache
+    )
+
+
+def warm_dou(geoms, path_cache):
+    dou.load_or_process_dou(geoms["bbox_mollweide"], path_cache)
+
+
+def warm_sleuth(geoms, path_cache):
+    sp.load_or_prep_rasters(geoms["bbox_mollweide"], path_cache)
+
+
+def warm_growth(geoms, path_cache):
+    smod, built, pop = ghsl.load_plot_datasets(
+        geoms["bbox_mollweide"], path_cache, clip=True
+    )
+    ghsl.load_or_get_urb_growth_df(
+        smod=smod,
+        built=built,
+        pop=pop,
+        centroid_mollweide=geoms["uc_mollweide"].centroid,
+        path_cache=path_cache,
+    )
+
+
+def warm_land_cover(geoms, path_cache):
+    udw.load_or_get_lc_df(geoms["bbox_latlon"], path_cache)
+
+
+def warm_temperature(geoms, path_cache):
+    bbox_latlon = geoms["bbox_latlon"]
+    bbox_ee = ru.bbox_to_ee(bbox_latlon)
+    start_date, end_date = ht.date_format(SEASON, YEAR)
+
+    lst, proj = ht.get_lst(bbox_ee, start_date, end_date)
+    _, masks = wc.get_cover_and_masks(bbox_ee, proj)
+
+    img_cat = ht.get_cat_suhi(lst, masks, path_cache)
+    ht.load_or_get_t_areas(bbox_ee, img_cat, masks, path_cache)
+    ht.load_or_get_land_usage_df(bbox_ee, img_cat, path_cache)
+    ht.load_or_get_radial_distributions(
+        bbox_latlon, geoms["uc_latlon"], start_date, end_date, path_cache
+    )
+
+
+# Stages in execution order, later stages reuse the caches of earlier ones
+STAGES = {
+    "ghsl": warm_ghsl,
+    "dou": warm_dou,
+    "sleuth": warm_sleuth,
+    "growth": warm_growth,
+    "land_cover": warm_land_cover,
+    "temperature": warm_temperature,
+}
+
+
+def warm_city(country, city, stages, path_fua=PATH_FUA, path_cache=PATH_CACHE):
+    """Runs the given stages for a single city.
+
+    A failing stage doesn't stop the rest, its error is recorded instead.
+
+    Returns
+    -------
+    id_hash : str
+        Hash of the city's cache directory.
+    results : dict
+        Dictionary mapping each stage to its status ('done' or 'failed'),
+        time in seconds and error message, if any.
+
+    """
+
+    geoms = get_city_geometries(city, country, path_fua)
+    city_cache = Path(path_cache) / str(geoms["hash"])
+    city_cache.mkdir(exist_ok=True, parents=True)
+
+    results = {}
+    for stage in stages:
+        start = time.perf_counter()
+        try:
+            STAGES[stage](geoms, city_cache)
+            result = {"status": "done"}
+        except Exception as e:
+            result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+        result["seconds"] = round(time.perf_counter() - start, 2)
+        results[stage] = result
+
+    return geoms["hash"], results
+
+
+def load_catalog(countries=None, cities=None, path_fua=PATH_FUA):
+    """Returns the (country, city) pairs of the catalog, optionally only
+    the ones in the given lists of countries and cities."""
+
+    df = gpd.read_file(path_fua / "cities_fua.gpkg")
+    if countries is not None:
+        df = df[df.country.isin(countries)]
+    if cities is not None:
+        df = df[df.city.isin(cities)]
+
+    return list(zip(df.country, df.city))
+
+
+def load_manifest(fpath=MANIFEST_PATH):
+    """Loads the progress manifest, a dictionary keyed by 'country/city'."""
+
+    fpath = Path(fpath)
+    if not fpath.exists():
+        return {}
+
+    with open(fpath, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, fpath=MANIFEST_PATH):
+    """Writes the progress manifest, through atomic_path so an interrupted
+    run never leaves it truncated."""
+
+    fpath = Path(fpath)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(fpath) as tmp_path, open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def get_pending(cities, stages, manifest):
+    """Returns (country, city, stages) for every city with stages not yet
+    done according to the manifest. Failed stages are retried."""
+
+    pending = []
+    for country, city in cities:
+        done = manifest.get(f"{country}/{city}", {}).get("stages", {})
+        city_stages = [s for s in stages if done.get(s, {}).get("status") != "done"]
+        if len(city_stages) > 0:
+            pending.append((country, city, city_stages))
+
+    return pending
+
+
+def _init_worker(dou_workers):
+    dou.MAX_WORKERS = dou_workers
+    try:
+        ee.Initialize()
+    except Exception as e:
+        print(f"Earth Engine not available, its stages will fail: {e}")
+
+
+def warm_catalog(
+    cities, stages, workers=4, manifest_path=MANIFEST_PATH, dou_workers=None
+):
+    """Runs the given stages for every city in a process pool, recording
+    progress in the manifest after each city.
+
+    Parameters
+    ----------
+    cities : list of tuple
+        List of (country, city) pairs.
+    stages : list of str
+        Stages to run, keys of STAGES.
+    workers : int
+        Number of worker processes.
+    manifest_path : Path
+        Path of the progress manifest.
+    dou_workers : int
+        Number of processes computing the DoU epochs of each city, see
+        ursa.degree_of_urbanization.MAX_WORKERS. Defaults to the cores
+        left to each worker.
+
+    """
+
+    if dou_workers is None:
+        dou_workers = max(1, (os.cpu_count() or 1) // workers)
+
+    manifest = load_manifest(manifest_path)
+    pending = get_pending(cities, stages, manifest)
+    print(f"{len(cities) - len(pending)} cities already warm, {len(pending)} pending.")
+
+    totals = {stage: [] for stage in stages}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(dou_workers,)
+    ) as executor:
+        futures = {
+            executor.submit(warm_city, country, city, city_stages): (country, city)
+            for country, city, city_stages in pending
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            country, city = futures[future]
+            key = f"{country}/{city}"
+            entry = manifest.setdefault(key, {"stages": {}})
+
+            try:
+                id_hash, results = future.result()
+            except Exception as e:
+                print(f"[{i}/{len(pending)}] {key}: failed ({e})")
+                continue
+
+            entry["hash"] = id_hash
+            entry["stages"].update(results)
+            save_manifest(manifest, manifest_path)
+
+            timings = []
+            for stage, result in results.items():
+                totals[stage].append(result["seconds"])
+                flag = "" if result["status"] == "done" else " FAILED"
+                timings.append(f"{stage} {result['seconds']:.1f} s{flag}")
+            print(f"[{i}/{len(pending)}] {key}: " + ", ".join(timings))
+
+    print(f"Done in {time.perf_counter() - start:.1f} s")
+    for stage, seconds in totals.items():
+        if len(seconds) > 0:
+            print(
+                f"    {stage}: {len(seconds)} cities, "
+                f"{sum(seconds):.1f} s total, {sum(seconds) / len(seconds):.1f} s mean"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--country", nargs="+", help="Only warm cities in these countries."
+    )
+    parser.add_argument("--city", nargs="+", help="Only warm these cities.")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run, all by default.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of worker processes."
+    )
+    parser.add_argument(
+        "--dou-workers",
+        type=int,
+        help="Number of processes computing the DoU epochs of each city, "
+        "by default the cores left to each worker.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=MANIFEST_PATH,
+        help="Path of the progress manifest.",
+    )
+    args = parser.parse_args()
+
+    cities = load_catalog(args.country, args.city)
+    stages = [stage for stage in STAGES if stage in args.stages]
+
+    warm_catalog(cities, stages, args.workers, args.manifest, args.dou_workers)
+
+
+if __name__ == "__main__":
+    main()